@@ -0,0 +1,74 @@
+"""Times expanding an alias as a guild gets more and more aliases.
+
+This goes through Aliases.expand_alias with the guild's trie already
+loaded, which is what happens for every prefixed message that isn't a
+command. Scanning every alias is there for comparison, since that's
+what the trie replaced (albeit in SQL).
+
+Run it from the root of the repo:
+
+    python benchmarks/alias.py [runs]
+"""
+import asyncio
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.alias import Aliases, _AliasTrie
+
+
+GUILD_ID = 1
+
+
+def _scan(aliases, content):
+    content = content.lower()
+    matches = [(alias, command) for alias, command in aliases
+               if content == alias or content.startswith(alias + ' ')]
+    return max(matches, key=lambda m: len(m[0]), default=None)
+
+
+async def _time_expand(cog, message, content, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        await cog.expand_alias(message, content)
+    return (time.perf_counter() - start) / runs * 1e6
+
+
+def _time_scan(aliases, content, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        _scan(aliases, content)
+    return (time.perf_counter() - start) / runs * 1e6
+
+
+async def bench(runs):
+    bot = types.SimpleNamespace(add_alias_resolver=lambda resolver: None)
+    cog = Aliases(bot)
+    message = types.SimpleNamespace(guild=types.SimpleNamespace(id=GUILD_ID))
+
+    print(f'{"aliases":>8} {"trie hit":>10} {"trie miss":>10} {"scan hit":>10} {"scan miss":>10}  (\N{GREEK SMALL LETTER MU}s/message)')
+    for count in (10, 100, 1000, 10000):
+        aliases = [(f'alias {i} thing', f'say {i}') for i in range(count)]
+        cog._get_trie.cache[GUILD_ID] = _AliasTrie(aliases)
+
+        hit = f'alias {count - 1} thing and some arguments'
+        miss = 'not an alias at all'
+        results = [
+            await _time_expand(cog, message, hit, runs),
+            await _time_expand(cog, message, miss, runs),
+            _time_scan(aliases, hit, max(1, runs // count)),
+            _time_scan(aliases, miss, max(1, runs // count)),
+        ]
+        print(f'{count:>8}', *(f'{r:>10.2f}' for r in results))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    asyncio.get_event_loop().run_until_complete(bench(runs))
+
+
+if __name__ == '__main__':
+    main()
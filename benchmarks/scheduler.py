@@ -0,0 +1,156 @@
+"""Benchmarks how fast DatabaseScheduler gets through a backlog of due entries.
+
+The database is faked with an in-memory one that sleeps for a bit on every
+query, so this measures the scheduler's own overhead and how many round
+trips it makes, rather than Postgres itself. batch_size=1 is roughly what
+the scheduler used to do, one entry per fetch and one delete per entry.
+
+Run it from the root of the repo:
+
+    python benchmarks/scheduler.py [pending] [latency in ms]
+"""
+import asyncio
+import collections
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils import scheduler
+
+
+_Record = collections.namedtuple('_Record', 'id expires event created args_kwargs')
+
+
+class _AsyncIter:
+    def __init__(self, items):
+        self._items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _FakeCursor:
+    def __init__(self, rows):
+        self._rows = rows
+
+    async def flatten(self):
+        return self._rows
+
+    async def fetch_row(self):
+        return self._rows[0] if self._rows else None
+
+
+class _FakeQuery:
+    def __init__(self, db):
+        self.db = db
+        self.n = None
+
+    def order_by(self, *args, **kwargs):
+        return self
+
+    def limit(self, n):
+        self.n = n
+        return self
+
+    async def all(self):
+        await self.db.round_trip('select')
+        rows = sorted(self.db.records.values(), key=lambda r: (r.expires, r.id))
+        return _AsyncIter(rows[:self.n])
+
+
+class _FakeSession:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def select(self, table):
+        return _FakeQuery(self.db)
+
+    def _delete(self, query, params):
+        assert query.lstrip().startswith('DELETE'), query
+        return [{'id': id} for id in params['ids'] if self.db.records.pop(id, None)]
+
+    async def execute(self, query, params):
+        await self.db.round_trip('delete')
+        self._delete(query, params)
+
+    async def cursor(self, query, params):
+        await self.db.round_trip('delete')
+        return _FakeCursor(self._delete(query, params))
+
+
+class FakeDB:
+    def __init__(self, records, latency):
+        self.records = {r.id: r for r in records}
+        self.latency = latency
+        self.queries = collections.Counter()
+
+    def bind_tables(self, md):
+        return md
+
+    def get_session(self):
+        return _FakeSession(self)
+
+    async def round_trip(self, kind):
+        self.queries[kind] += 1
+        await asyncio.sleep(self.latency)
+
+
+async def bench(pending, batch_size, latency, *, loop):
+    now = datetime.datetime.utcnow()
+    records = [
+        _Record(id=i, expires=now - datetime.timedelta(milliseconds=pending - i), event='bench',
+                created=now - datetime.timedelta(days=1), args_kwargs='{"args": [], "kwargs": {}}')
+        for i in range(1, pending + 1)
+    ]
+    db = FakeDB(records, latency)
+    sched = scheduler.DatabaseScheduler(db, batch_size=batch_size, loop=loop,
+                                        timefunc=datetime.datetime.utcnow)
+
+    dispatched = 0
+    finished = asyncio.Event()
+
+    def callback(entry):
+        nonlocal dispatched
+        dispatched += 1
+        if dispatched == pending:
+            finished.set()
+
+    sched.add_callback(callback)
+    start = time.perf_counter()
+    sched.run()
+    await finished.wait()
+    elapsed = time.perf_counter() - start
+    await sched.close()
+
+    queries = ', '.join(f'{n} {kind}s' for kind, n in sorted(db.queries.items()))
+    print(f'batch_size={batch_size:<4} {pending / elapsed:>10,.0f} events/sec  '
+          f'({elapsed:.2f}s, {queries})')
+
+
+def main():
+    pending = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 1) / 1000
+
+    loop = asyncio.get_event_loop()
+    print(f'{pending} pending entries, {latency * 1000:g}ms per query')
+    for batch_size in (1, 100, scheduler.DatabaseScheduler.BATCH_SIZE):
+        loop.run_until_complete(bench(pending, batch_size, latency, loop=loop))
+
+
+if __name__ == '__main__':
+    main()
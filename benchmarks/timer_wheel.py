@@ -0,0 +1,84 @@
+"""Compares a Task per timer against the TimerWheel for lots of short timers.
+
+This adds a bunch of timers with random delays, and measures how long it
+takes to add them all, how much memory they take up, and how long it takes
+until every one of them has fired. Memory is measured in a separate run,
+because tracemalloc slows everything down quite a bit.
+
+Run it from the root of the repo:
+
+    python benchmarks/timer_wheel.py [timers]
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils.scheduler import TimerWheel
+
+
+async def _sleep_then_call(delay, callback, item):
+    await asyncio.sleep(delay)
+    callback(item)
+
+
+def _add_tasks(delays, callback, loop):
+    for i, delay in enumerate(delays):
+        loop.create_task(_sleep_then_call(delay, callback, i))
+
+
+def _add_wheel(delays, callback, loop):
+    wheel = TimerWheel(callback, loop=loop)
+    for i, delay in enumerate(delays):
+        wheel.add(delay, i)
+    return wheel
+
+
+async def bench(add, delays, *, loop, trace=False):
+    fired = 0
+    finished = asyncio.Event()
+
+    def callback(item):
+        nonlocal fired
+        fired += 1
+        if fired == len(delays):
+            finished.set()
+
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    # Holding onto the result so the wheel doesn't get collected.
+    result = add(delays, callback, loop)
+    added = time.perf_counter() - start
+    if trace:
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    await finished.wait()
+    elapsed = time.perf_counter() - start
+    del result
+
+    if trace:
+        return memory
+    return added, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    delays = [random.uniform(1, 2) for _ in range(count)]
+
+    loop = asyncio.get_event_loop()
+    print(f'{count} timers, 1-2 second delays')
+    for name, add in [('task-per-entry', _add_tasks), ('timer wheel', _add_wheel)]:
+        added, elapsed = loop.run_until_complete(bench(add, delays, loop=loop))
+        memory = loop.run_until_complete(bench(add, delays, loop=loop, trace=True))
+        print(f'{name:<15} add {added * 1000:>5.0f}ms, {memory / 2 ** 20:>5.1f}MB live after adding, '
+              f'all fired after {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@ import discord
 import enum
 
 from collections import defaultdict, deque
-from datetime import datetime
 from discord.ext import commands
 
 from .utils import time
@@ -23,16 +22,41 @@ class AFK(Cog):
         self.bot = bot
         # Debating whether or not I should use a DB. Because this would be queried
         # for EVERY message, making it extremely intense.
-        self.afks = JSONFile("afk.json")
-        self.afk_configs = JSONFile('afkconfig.json')
-        self.user_message_queues = defaultdict(deque)
+        #
+        # People go AFK and come back constantly, so we don't want to dump the
+        # whole thing every time.
+        self.afks = JSONFile("afk.json", flush_interval=5, journal=True)
+        self.afk_configs = JSONFile('afkconfig.json', flush_interval=5)
+
+        # The JSONs are only there for persistence. Everything per-message
+        # goes through these, so we don't have to str() every ID we come across.
+        self._afks = {int(k): v for k, v in self.afks.items()}
+        self._afk_say_guilds = {int(k) for k, v in self.afk_configs.items() if v['send_afk_message']}
+        # member_id -> (guild_id, display_name, avatar_url, embed)
+        self._afk_embeds = {}
+
+        self.user_message_queues = defaultdict(lambda: deque(maxlen=AFKConfig.MAX_MESSAGES))
+        bot.add_message_listener(self.on_afk_message, self._should_check_message, name='afk')
+
+    def __unload(self):
+        self.bot.loop.create_task(self.on_shutdown())
+
+    async def on_shutdown(self):
+        await self.afks.close()
+        await self.afk_configs.close()
 
     async def _get_afk_embed(self, member):
-        message = self.afks.get(member.id)
+        message = self._afks.get(member.id)
         if message is None:
             return None
 
         avatar = member.avatar_url
+        key = (member.guild.id, member.display_name, avatar)
+        with contextlib.suppress(KeyError):
+            *cached_key, embed = self._afk_embeds[member.id]
+            if tuple(cached_key) == key:
+                return embed
+
         colour = await user_color(member)
         title = f"{member.display_name} is AFK"
 
@@ -41,40 +65,47 @@ class AFK(Cog):
                 .set_footer(text=f"ID: {member.id}")
                 )
 
-        with contextlib.suppress(IndexError):
-            embed.timestamp = self.user_message_queues[member.id][-1]
+        message_queue = self.user_message_queues.get(member.id)
+        if message_queue:
+            embed.timestamp = message_queue[-1]
+
+        self._afk_embeds[member.id] = (*key, embed)
         return embed
 
     def _has_messaged_too_much(self, author):
         message_queue = self.user_message_queues[author.id]
-        if len(message_queue) <= AFKConfig.MAX_MESSAGES:
+        if len(message_queue) < message_queue.maxlen:
             return False
 
-        delta = (message_queue.popleft() - datetime.now()).total_seconds()
-        return delta >= AFKConfig.MAX_INTERVAL
+        delta = (message_queue[-1] - message_queue[0]).total_seconds()
+        return delta < AFKConfig.MAX_INTERVAL
+
+    async def _set_afk(self, author, message):
+        self._afks[author.id] = message
+        self._afk_embeds.pop(author.id, None)
+        await self.afks.put(author.id, message)
 
     async def _remove_afk(self, author):
-        await self.afks.remove(author.id)
+        self._afks.pop(author.id, None)
+        self._afk_embeds.pop(author.id, None)
         self.user_message_queues.pop(author.id, None)
+        await self.afks.remove(author.id)
 
     def _afk_messages_enabled(self, server):
-        if server.id not in self.afk_configs:
-            return False
-
-        return self.afk_configs[server.id]['send_afk_message']
+        return server.id in self._afk_say_guilds
 
     @commands.command()
     async def afk(self, ctx, *, message: str=None):
         """Sets your AFK message"""
         member = ctx.author
         if message is None:
-            if member.id not in self.afks:
+            if member.id not in self._afks:
                 return await ctx.send("You need a message... I think.")
 
             await self._remove_afk(member)
             await ctx.send("You are no longer AFK")
         else:
-            await self.afks.put(member.id, message)
+            await self._set_afk(member, message)
             await ctx.send("You are AFK")
 
     @commands.command(name='afksay')
@@ -88,6 +119,11 @@ class AFK(Cog):
         config = self.afk_configs.get(ctx.guild.id, {'send_afk_message': False})
         config['send_afk_message'] = send_afk_message
         await self.afk_configs.put(ctx.guild.id, config)
+
+        if send_afk_message:
+            self._afk_say_guilds.add(ctx.guild.id)
+        else:
+            self._afk_say_guilds.discard(ctx.guild.id)
         await ctx.send('\N{THUMBS UP SIGN}')
 
     async def check_user_message(self, message):
@@ -98,10 +134,12 @@ class AFK(Cog):
         if author.id == self.bot.user.id:
             return
 
-        if author.id not in self.afks:
+        if author.id not in self._afks:
             return
 
         self.user_message_queues[author.id].append(message.created_at)
+        # The timestamp's changed, so the embed is out of date now.
+        self._afk_embeds.pop(author.id, None)
         if self._has_messaged_too_much(author):
             await self._remove_afk(author)
             await message.channel.send(f"{author.mention}, you are no longer AFK as you have messaged "
@@ -115,17 +153,34 @@ class AFK(Cog):
         if message.author.id == self.bot.user.id:
             return
 
+        afks = self._afks
         for user in message.mentions:
+            if user.id not in afks:
+                continue
+
             afk_embed = await self._get_afk_embed(user)
             if afk_embed:
                 await message.channel.send(embed=afk_embed)
 
-    async def on_message(self, message):
-        if message.guild is None:
-            return
+    def _mentions_afk(self, message):
+        # raw_mentions is just a regex over the content, so this avoids having
+        # to resolve every mentioned member when no one mentioned is AFK.
+        afks = self._afks
+        return any(user_id in afks for user_id in message.raw_mentions)
+
+    def _should_check_message(self, message, info):
+        if not self._afks or message.guild is None:
+            return False
+
+        if not self._afk_messages_enabled(message.guild):
+            return False
+
+        return message.author.id in self._afks or (info.mentions and self._mentions_afk(message))
 
+    async def on_afk_message(self, message, info):
         await self.check_user_message(message)
-        await self.check_user_mention(message)
+        if info.mentions and self._mentions_afk(message):
+            await self.check_user_mention(message)
 
 def setup(bot):
     bot.add_cog(AFK(bot))
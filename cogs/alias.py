@@ -1,10 +1,10 @@
 import asyncqlio
 import collections
-import copy
 
 from discord.ext import commands
 
 from .tables.base import TableBase
+from .utils import cache
 from .utils.paginator import ListPaginator
 
 from core.cog import Cog
@@ -27,6 +27,67 @@ def _first_word_is_command(group, string):
     return _first_word(string) in group.all_commands
 
 
+class _AliasTrie:
+    """A guild's aliases, stored word by word.
+
+    This lets us find the longest alias a message starts with without
+    having to go through every single alias the guild has.
+    """
+    __slots__ = ('_root', '_size')
+
+    def __init__(self, aliases=()):
+        self._root = {}
+        self._size = 0
+        for alias, command in aliases:
+            self[alias] = command
+
+    def __len__(self):
+        return self._size
+
+    def __setitem__(self, alias, command):
+        node = self._root
+        for word in alias.split(' '):
+            node = node.setdefault(word, {})
+
+        # Words are always strings, so None is safe to use as the end marker.
+        self._size += None not in node
+        node[None] = (alias, command)
+
+    def __delitem__(self, alias):
+        path = [self._root]
+        words = alias.split(' ')
+        for word in words:
+            path.append(path[-1][word])
+
+        del path[-1][None]
+        self._size -= 1
+
+        # Prune any branches that don't lead to an alias anymore.
+        for node, word in zip(reversed(path[:-1]), reversed(words)):
+            if node[word]:
+                break
+            del node[word]
+
+    def pop(self, alias, default=None):
+        try:
+            del self[alias]
+        except KeyError:
+            return default
+        return alias
+
+    def longest_match(self, content):
+        """Returns the (alias, command) of the longest alias the content starts
+        with, or None if there isn't one.
+        """
+        node, match = self._root, None
+        for word in content.lower().split(' '):
+            node = node.get(word)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+
 class AliasName(commands.Converter):
     async def convert(self, ctx, arg):
         lowered = arg.lower().strip()
@@ -43,6 +104,7 @@ class AliasName(commands.Converter):
 class Aliases(Cog):
     def __init__(self, bot):
         self.bot = bot
+        bot.add_alias_resolver(self.expand_alias)
 
     # idk if this should be in a command group...
     #
@@ -78,7 +140,11 @@ class Aliases(Cog):
                    DO UPDATE SET command = {command};
                 """
         params = {'guild_id': ctx.guild.id, 'alias': alias, 'command': command}
-        await ctx.session.execute(query, params)
+        # Committing right away, so the trie is only touched if the alias was
+        # actually saved. Otherwise it'd serve an alias that doesn't exist.
+        async with ctx.acquire():
+            await ctx.session.execute(query, params)
+        self._update_trie(ctx.guild.id, alias, command)
         # row = Alias(guild_id=ctx.guild.id, alias=alias, command=command)
         # await ctx.session.insert.add_row(row).on_conflict(AliasCC).update(Alias.command)
         await ctx.send(f'Ok, typing "{ctx.prefix}{alias}" will now be '
@@ -88,7 +154,12 @@ class Aliases(Cog):
     @commands.has_permissions(manage_guild=True)
     async def delalias(self, ctx, *, alias):
         """Deletes an alias."""
-        await ctx.session.delete.table(Alias).where((Alias.guild_id == ctx.guild.id) & (Alias.alias == alias))
+        # Aliases are stored lowercase, see AliasName
+        alias = alias.lower().strip()
+        # See alias for why this is committed first.
+        async with ctx.acquire():
+            await ctx.session.delete.table(Alias).where((Alias.guild_id == ctx.guild.id) & (Alias.alias == alias))
+        self._update_trie(ctx.guild.id, alias, None)
         await ctx.send(f'Ok... bye "{alias}"')
 
     @commands.command()
@@ -99,36 +170,43 @@ class Aliases(Cog):
         pages = ListPaginator(ctx, entries)
         await pages.interact()
 
-    async def _get_alias(self, guild_id, content):
-        async with self.bot.db.get_session() as s:
-            # Must use raw SQL because asyncqlio doesn't support string concatenation,
-            # nor does it support binary ops with columns that aren't setters.
-            query = """SELECT alias, command FROM command_aliases
-                       WHERE guild_id = {guild_id}
-                       AND ({content} ILIKE alias || ' %' OR {content} = alias)
-                       ORDER BY length(alias)
-                       LIMIT 1;
-                    """
-            params = {'guild_id': guild_id, 'content': content}
-            return await s.fetch(query, params)
-
-    def _get_prefix(self, message):
-        prefixes = self.bot.get_guild_prefixes(message.guild)
-        return next(filter(message.content.startswith, prefixes), None)
-
-    async def on_message(self, message):
-        prefix = self._get_prefix(message)
-        if not prefix:
-            return
-        len_prefix = len(prefix)
-
-        alias = await self._get_alias(message.guild.id, message.content[len_prefix:])
-        if not alias:
-            return
-
-        new_message = copy.copy(message)
-        new_message.content = f"{prefix}{alias['command']}{message.content[len_prefix + len(alias['alias']):]}"
-        await self.bot.process_commands(new_message)
+    # Aliases are checked on every prefixed message, so the whole guild's
+    # aliases are loaded once and matched in memory from then on.
+    @cache.cache(maxsize=1024, ttl=3600, make_key=lambda a, kw: a[-1])
+    async def _get_trie(self, guild_id):
+        async with self.bot.db.get_session() as session:
+            query = session.select.from_(Alias).where(Alias.guild_id == guild_id)
+            return _AliasTrie([(row.alias, row.command) async for row in await query.all()])
+
+    def _update_trie(self, guild_id, alias, command):
+        trie = self._get_trie.cache.get(guild_id, count=False)
+        if trie is None:
+            # It might be getting loaded right now, in which case it could
+            # be missing this change. It'll just be loaded again later.
+            self._get_trie.invalidate(self, guild_id)
+        elif command is None:
+            trie.pop(alias)
+        else:
+            trie[alias] = command
+
+    # Called by the bot in get_context, only if the first word isn't a command.
+    async def expand_alias(self, message, content):
+        if message.guild is None:
+            return None
+
+        # Don't bother with guilds that we know have no aliases.
+        trie = self._get_trie.cache.get(message.guild.id, count=False)
+        if trie is None:
+            trie = await self._get_trie(message.guild.id)
+        if not trie:
+            return None
+
+        match = trie.longest_match(content)
+        if match is None:
+            return None
+
+        alias, command = match
+        return f'{command}{content[len(alias):]}'
 
 
 def setup(bot):
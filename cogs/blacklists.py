@@ -7,6 +7,7 @@ from discord.ext import commands
 
 from .tables.base import TableBase
 from .utils import disambiguate
+from .utils.index import SnowflakeIndex
 from .utils.misc import emoji_url, truncate
 
 from core.cog import Cog
@@ -45,26 +46,44 @@ _GuildOrUser = disambiguate.union(discord.Guild, discord.User)
 class Blacklists(Cog, hidden=True):
     def __init__(self, bot):
         self.bot = bot
+        # Blacklists aren't per-guild, so everything goes into the None bucket.
+        # The value of each entry is the reason for the blacklist.
+        self.blacklist = SnowflakeIndex()
+        bot.loop.create_task(self._load_blacklist())
+
+    async def _load_blacklist(self):
+        async with self.bot.db.get_session() as session:
+            query = session.select.from_(Blacklist)
+            entries = [(None, row.snowflake, row.reason) async for row in await query.all()]
+
+        self.blacklist.load(entries)
 
     async def __local_check(self, ctx):
         return await ctx.bot.is_owner(ctx.author)
 
-    async def __global_check_once(self, ctx):
-        async def get_blacklist(id):
-            return await ctx.session.select.from_(Blacklist).where(Blacklist.snowflake == id).first()
+    async def _get_blacklist(self, ctx, id):
+        """Returns the (snowflake, reason) pair if the ID was blacklisted, None otherwise."""
+        if self.blacklist.ready:
+            return self.blacklist.find(None, id)
 
-        row = await get_blacklist(ctx.author.id)
-        if row:
-            raise Blacklisted('You have been blacklisted by the owner.', row.reason)
+        # The index hasn't been loaded yet, so we have to go to the DB.
+        self.blacklist.stats['fallbacks'] += 1
+        row = await ctx.session.select.from_(Blacklist).where(Blacklist.snowflake == id).first()
+        return row and (row.snowflake, row.reason)
+
+    async def __global_check_once(self, ctx):
+        entry = await self._get_blacklist(ctx, ctx.author.id)
+        if entry:
+            raise Blacklisted('You have been blacklisted by the owner.', entry[1])
 
         # Only check if it's in DM after checking the user to prevent users
         # from attempting to bypass the blacklist through DM
         if ctx.guild is None:
             return True
 
-        row = await get_blacklist(ctx.guild.id)
-        if row:
-            raise Blacklisted('This server has been blacklisted by the owner.', row.reason)
+        entry = await self._get_blacklist(ctx, ctx.guild.id)
+        if entry:
+            raise Blacklisted('This server has been blacklisted by the owner.', entry[1])
 
         return True
 
@@ -108,6 +127,7 @@ class Blacklists(Cog, hidden=True):
         except asyncpg.UniqueViolationError:
             return await ctx.send(f'{server_or_user} has already been blacklisted.')
         else:
+            self.blacklist.add(None, server_or_user.id, reason)
             await self._show_blacklist_embed(ctx, 0xd50000, 'blacklisted', _blocked_icon,
                                              server_or_user, reason, time)
 
@@ -126,6 +146,7 @@ class Blacklists(Cog, hidden=True):
                 return await ctx.send(f"{server_or_user} isn't blacklisted.")
 
             await session.remove(row)
+            self.blacklist.discard(None, server_or_user.id)
             await self._show_blacklist_embed(ctx, 0x4CAF50, 'unblacklisted', _unblocked_icon,
                                              server_or_user, reason, datetime.datetime.utcnow())
 
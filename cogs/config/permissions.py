@@ -14,6 +14,7 @@ from ._initroot import InitRoot
 from ..tables.base import TableBase
 from ..utils import cache, formats, disambiguate
 from ..utils.converter import BotCommand, BotCogConverter
+from ..utils.index import SnowflakeIndex
 from ..utils.misc import emoji_url, truncate, unique
 from ..utils.paginator import ListPaginator
 
@@ -139,6 +140,52 @@ class Server(namedtuple('Server', 'server')):
         return str(self.server)
 
 
+class _PermissionTable:
+    """A server's permissions, compiled so that checking a command doesn't
+    have to go through every combination of object and command name.
+
+    For each command, only the rules that could possibly apply to it are
+    kept, and since the names are checked in order for each object, only
+    the first name that has a rule for an object actually matters. So
+    every command ends up as a {snowflake: (name, whitelist)} dict, which
+    is built the first time the command is checked.
+    """
+    __slots__ = ('_rules', '_compiled')
+
+    def __init__(self, rows):
+        # name -> {snowflake: whitelist}
+        self._rules = defaultdict(dict)
+        for snowflake, name, whitelist in rows:
+            rules = self._rules[name]
+            # allow overrides deny
+            rules[snowflake] = rules.get(snowflake, False) or whitelist
+
+        # qualified name -> {snowflake: (name, whitelist)}
+        self._compiled = {}
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def rules_for(self, command):
+        try:
+            return self._compiled[command.qualified_name]
+        except KeyError:
+            pass
+
+        names = itertools.chain(
+            map(_command_node, _walk_parents(command)),
+            (command.cog_name, ALL_MODULES_KEY)
+        )
+
+        compiled = {}
+        for name in names:
+            for snowflake, whitelist in self._rules.get(name, {}).items():
+                compiled.setdefault(snowflake, (name, whitelist))
+
+        self._compiled[command.qualified_name] = compiled
+        return compiled
+
+
 class _DummyEntry(namedtuple('_DummyEntry', 'id')):
     """This class ensures we have a mentionable object for ->ignores"""
     __slots__ = ()
@@ -193,6 +240,18 @@ class Permissions(InitRoot):
     def __init__(self, bot):
         super().__init__(bot)
 
+        # Plonks are checked on every single command, so we keep them all
+        # in memory rather than querying the DB each time.
+        self.plonks = SnowflakeIndex()
+        bot.loop.create_task(self._load_plonks())
+
+    async def _load_plonks(self):
+        async with self.bot.db.get_session() as session:
+            query = session.select.from_(Plonks)
+            entries = [(row.guild_id, row.entity_id, None) async for row in await query.all()]
+
+        self.plonks.load(entries)
+
     async def __global_check_once(self, ctx):
         if not ctx.guild:
             return True
@@ -200,6 +259,11 @@ class Permissions(InitRoot):
         if await ctx.bot.is_owner(ctx.author):
             return True
 
+        if self.plonks.ready:
+            return self.plonks.find(ctx.guild.id, ctx.author.id, ctx.channel.id) is None
+
+        # The index hasn't been loaded yet, so we have to go to the DB.
+        self.plonks.stats['fallbacks'] += 1
         query = (ctx.session.select.from_(Plonks)
                             .where((Plonks.guild_id == ctx.guild.id)
                                    & Plonks.entity_id.in_(ctx.channel.id, ctx.author.id))
@@ -292,19 +356,14 @@ class Permissions(InitRoot):
         method = self._set_one_permission if len(entities) == 1 else self._bulk_set_permissions
         await method(session, guild_id, name, *entities, whitelist=whitelist)
 
-    @cache.cache(maxsize=None, make_key=lambda a, kw: a[-1])
+    @cache.cache(maxsize=2048, ttl=3600, make_key=lambda a, kw: a[-1])
     async def _get_permissions(self, session, guild_id):
         query = (session.select.from_(CommandPermissions)
                         .where(CommandPermissions.guild_id == guild_id)
                  )
 
-        lookup = defaultdict(lambda: (set(), set()))
-        async for row in await query.all():
-            lookup[row.snowflake][row.whitelist].add(row.name)
-
-        # Converting this to a dict so future retrievals of this via cache
-        # don't accidentally modify this.
-        return dict(lookup)
+        rows = [(row.snowflake, row.name, row.whitelist) async for row in await query.all()]
+        return _PermissionTable(rows)
 
     async def __global_check(self, ctx):
         if not ctx.guild:  # Custom permissions don't really apply in DMs
@@ -320,8 +379,8 @@ class Permissions(InitRoot):
             return True
 
         # XXX: Should I have a check for if the table/relation actually exists?
-        lookup = await self._get_permissions(ctx.session, ctx.guild.id)
-        if not lookup:
+        table = await self._get_permissions(ctx.session, ctx.guild.id)
+        if not table:
             # "Fast" path
             return True
 
@@ -333,21 +392,12 @@ class Permissions(InitRoot):
         if root in {self.enable, self.disable, self.undo}:
             return True
 
-        dummy_server = Server(ctx.guild)
-
-        objects = itertools.chain(
-            [('user', ctx.author)],
-            zip(itertools.repeat('role'), sorted(ctx.author.roles, reverse=True)),
-            [('channel', ctx.channel),
-             ('server', dummy_server)],
-        )
-
-        names = itertools.chain(
-            map(_command_node, _walk_parents(ctx.command)),
-            (ctx.command.cog_name, ALL_MODULES_KEY)
-        )
+        rules = table.rules_for(ctx.command)
+        if not rules:
+            # Still a pretty fast path, none of the rules apply to this command.
+            return True
 
-        # The following code is roughly along the lines of this:
+        # The permissions are applied roughly along the lines of this:
         # Apply guild-level denies first
         # then guild-level allows
         # then channel-level denies
@@ -358,29 +408,32 @@ class Permissions(InitRoot):
         # The levels go up the command tree, starting from the root command,
         # and ending at the actual sub command.
         #
-        # However, there's one critical difference: we go in reverse order here,
-        # starting from the user level, then ending at the guild level. This gives
-        # the exact same result, because we're really looking for the last perm that
-        # would be applied here. However, by going in reverse this allows for two
-        # things:
+        # However, we go in reverse order here, starting from the user level,
+        # then ending at the guild level. This gives the exact same result,
+        # because we're really looking for the last perm that would be applied.
+        # This lets us stop as soon as we find one, and it lets us say which
+        # command and which level it's disabled on.
         #
-        # 1. Optimization: By returning early we don't have to evaluate all the
-        #    permissions. This helps a lot as a lot of commands will be thrown at
-        #    the bot.
-        # 2. The ability to stop early and throw an exception indicating which
-        #    command and which level it's disabled on. If we go forwards, we won't
-        #    know the last perm that will be applied, but here we'll able to know
-        #    because we're looking for the first perm.
-        #
-        for (typename, obj), name in itertools.product(objects, names):
-            if obj.id not in lookup:  # more likely for an id to not be in here.
+        # The table already picked out the relevant command name for each
+        # object, so all that's left is to find the first object with a rule.
+        # For roles that's the highest one.
+        author = ctx.author
+        roles = [role for role in author.roles if role.id in rules]
+        objects = (
+            ('user', author if author.id in rules else None),
+            ('role', max(roles) if roles else None),
+            ('channel', ctx.channel if ctx.channel.id in rules else None),
+            ('server', Server(ctx.guild) if None in rules else None),
+        )
+
+        for typename, obj in objects:
+            if obj is None:
                 continue
 
-            if name in lookup[obj.id][True]:  # allow overrides deny
+            name, whitelist = rules[obj.id]
+            if whitelist:
                 return True
-
-            elif name in lookup[obj.id][False]:
-                raise PermissionDenied(f'{name} is denied on the {typename} level', name, obj)
+            raise PermissionDenied(f'{name} is denied on the {typename} level', name, obj)
 
         return True
 
@@ -542,6 +595,9 @@ class Permissions(InitRoot):
         conn = ctx.session.transaction.acquired_connection
         await conn.copy_records_to_table('plonks', columns=('guild_id', 'entity_id'), records=to_insert)
 
+        for _, entity_id in to_insert:
+            self.plonks.add(guild_id, entity_id)
+
     async def _display_plonked(self, ctx, entries, plonk):
         # things = channels, members
 
@@ -577,6 +633,7 @@ class Permissions(InitRoot):
                 await ctx.send(f"I'm already ignoring {thing}...")
                 raise commands.UserInputError
 
+            self.plonks.add(ctx.guild.id, thing.id)
         else:
             await self._bulk_ignore_entries(ctx, channels_or_members)
 
@@ -590,11 +647,12 @@ class Permissions(InitRoot):
         If no channel or member is specified, it unignores the current channel.
         """
         entities = channels_or_members or [ctx.channel]
-        condition = (Plonks.entity_id.in_(*(e.id for e in entities))
+        condition = (Plonks.entity_id == entities[0].id
                      if len(entities) == 1 else
-                     Plonks.entity_id == entities[0].id)
+                     Plonks.entity_id.in_(*(e.id for e in entities)))
 
         await ctx.session.delete.table(Plonks).where((Plonks.guild_id == ctx.guild.id) & condition)
+        self.plonks.discard(ctx.guild.id, *(e.id for e in entities))
         await self._display_plonked(ctx, entities, plonk=False)
 
     @commands.command(aliases=['plonks'])
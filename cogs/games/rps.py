@@ -24,7 +24,7 @@ RPSLS_COUNTERS = {
 
 Winner = namedtuple('Winner', 'name image')
 
-class RockPaperScissors(Cog):
+class RockPaperScissors(Cog, needs_db=False):
     @staticmethod
     def pick(elem, counters):
         weights = [(elem in v) * 0.5 + 0.5 for v in counters.values()]
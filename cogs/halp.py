@@ -86,7 +86,7 @@ _bracket_repls = {
 }
 
 
-class Help(Cog):
+class Help(Cog, needs_db=False):
     def __init__(self, bot):
         self.bot = bot
         self.bot.remove_command('help')
@@ -53,7 +53,7 @@ async def _mee6_stats(session, member):
     raise ResultsNotFound(f"{member} does not have a mee6 level. :frowning:")
 
 
-@cache.cache(maxsize=None)
+@cache.cache(maxsize=1024)
 async def _role_creator(role):
     """Returns the user who created the role.
 
@@ -250,7 +250,7 @@ class ChannelPaginator(ListPaginator):
 DISCORD_BOTS_ID = 110373943822540800
 
 
-class Meta(Cog):
+class Meta(Cog, needs_db=False):
     """Info related commands"""
 
     def __init__(self, bot):
@@ -6,6 +6,7 @@ import discord
 import functools
 import heapq
 import itertools
+import logging
 
 from collections import Counter, deque, namedtuple
 from discord.ext import commands
@@ -21,6 +22,8 @@ from .utils.paginator import ListPaginator, EmbedFieldPages
 
 from core.cog import Cog
 
+log = logging.getLogger(__name__)
+
 
 class Warn(TableBase, table_name='warn_entries'):
     id = asyncqlio.Column(asyncqlio.Serial, primary_key=True)
@@ -80,6 +83,19 @@ class MemberID(union):
         return member
 
 
+async def _resolve_user(bot, target):
+    # MemberID gives back a discord.Object for raw IDs, which doesn't have
+    # a name or an avatar, so anything that shows the target needs the user.
+    if isinstance(target, discord.abc.User):
+        return target
+
+    user = bot.get_user(target.id)
+    if user is None:
+        with contextlib.suppress(discord.HTTPException):
+            user = await bot.get_user_info(target.id)
+    return user or target
+
+
 class BannedMember(commands.Converter):
     async def convert(self, ctx, arg):
         ban_list = await ctx.guild.bans()
@@ -95,6 +111,128 @@ class BannedMember(commands.Converter):
         return thing
 
 
+# How many members a mass action will apply to at once. discord.py takes
+# care of the actual rate-limits, this is just so we don't dump a few hundred
+# requests on it at once.
+MASS_ACTION_CONCURRENCY = 5
+# How often the progress message of a mass action gets updated, in seconds.
+MASS_ACTION_PROGRESS_INTERVAL = 2
+
+
+class _Slowmode:
+    """The in-memory form of a slowmode, which also remembers when each
+    member last spoke.
+
+    Members are kept in two generations, each one *duration* seconds long.
+    When a generation is over the older one is thrown out wholesale, so
+    anyone who hasn't spoken in a while is forgotten without having to
+    sweep through every member. This means only the members who spoke in the
+    last two generations are ever kept around.
+    """
+    __slots__ = ('duration', 'no_immune', '_current', '_previous', '_rotate_at')
+
+    def __init__(self, duration, no_immune):
+        self.duration = duration
+        self.no_immune = no_immune
+        self._current = {}
+        self._previous = {}
+        self._rotate_at = 0
+
+    def _rotate(self, now):
+        if now < self._rotate_at:
+            return
+
+        if now >= self._rotate_at + self.duration:
+            # No one spoke for an entire generation, so everyone's stale.
+            self._previous.clear()
+        else:
+            self._previous, self._current = self._current, self._previous
+        self._current.clear()
+        self._rotate_at = now + self.duration
+
+    def is_limited(self, member_id, now):
+        """Returns True if the member spoke too recently. Otherwise the
+        member's last message is updated to now.
+        """
+        self._rotate(now)
+
+        last = self._current.get(member_id)
+        if last is None:
+            last = self._previous.get(member_id)
+
+        if last is not None and now - last < self.duration:
+            return True
+
+        self._current[member_id] = now
+        return False
+
+
+def _message_time(message_id):
+    # Saves us from making a datetime for every message.
+    return ((message_id >> 22) + discord.utils.DISCORD_EPOCH) / 1000
+
+
+class _DeletionQueue:
+    """Deletes a channel's messages in batches.
+
+    Deleting every message one at a time is a request each, and in a busy
+    channel that runs out the delete bucket pretty quickly. Instead messages
+    are collected for a bit, then bulk deleted 100 at a time.
+    """
+    INTERVAL = 1
+    # Discord won't bulk delete more than this many messages at once...
+    MAX_BULK = 100
+    # ...or anything that's older than 14 days. There's a bit of leeway
+    # here in case our clock is a little off.
+    MAX_BULK_AGE = datetime.timedelta(days=14, minutes=-5)
+
+    def __init__(self, channel, *, loop):
+        self.channel = channel
+        self._loop = loop
+        self._messages = []
+        self._task = None
+
+    def put(self, message):
+        self._messages.append(message)
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._messages:
+                await asyncio.sleep(self.INTERVAL)
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def flush(self):
+        messages, self._messages = self._messages, []
+        if not messages:
+            return
+
+        channel = self.channel
+        if channel.permissions_for(channel.guild.me).manage_messages:
+            cutoff = datetime.datetime.utcnow() - self.MAX_BULK_AGE
+            bulk = [m for m in messages if m.created_at > cutoff]
+            single = [m for m in messages if m.created_at <= cutoff]
+        else:
+            bulk, single = [], messages
+
+        for i in range(0, len(bulk), self.MAX_BULK):
+            chunk = bulk[i:i + self.MAX_BULK]
+            try:
+                await channel.delete_messages(chunk)
+            except discord.Forbidden:
+                # We lost our perms halfway through, there's nothing we can do now.
+                return
+            except discord.HTTPException:
+                single.extend(chunk)
+
+        for message in single:
+            with contextlib.suppress(discord.HTTPException):
+                await message.delete()
+
+
 _warn_punishments = ['mute', 'kick', 'softban', 'tempban', 'ban',]
 _is_valid_punishment = frozenset(_warn_punishments).__contains__
 
@@ -107,8 +245,31 @@ class Moderator(Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.slowmodes = JSONFile('slowmodes.json')
-        self.slowmode_bucket = {}
+        self.slowmodes = JSONFile('slowmodes.json', flush_interval=5)
+        # The JSON is only for persistence, the actual checking goes through this.
+        self._slowmodes = {}
+        for guild_id in self.slowmodes:
+            try:
+                guild_id = int(guild_id)
+            except ValueError:
+                # slowmode noimmune used to save things under the guild's name
+                # by mistake. There's no telling which guild that was, so it's
+                # just skipped rather than taking the whole cog down with it.
+                log.warning('Skipping slowmode config with a non-ID key %r', guild_id)
+                continue
+            self._update_slowmodes(guild_id)
+        self._deletion_queues = {}
+        bot.add_message_listener(self.check_slowmode, self._has_slowmode, name='slowmode')
+
+    def __unload(self):
+        self.bot.loop.create_task(self.slowmodes.close())
+        for queue in self._deletion_queues.values():
+            self.bot.loop.create_task(queue.flush())
+
+    async def on_shutdown(self):
+        await self.slowmodes.close()
+        for queue in self._deletion_queues.values():
+            await queue.flush()
 
     async def call_mod_log_invoke(self, invoke, ctx):
         mod_log = ctx.bot.get_cog('ModLog')
@@ -124,34 +285,52 @@ class Moderator(Cog):
     def _is_slowmode_immune(member):
         return member.guild_permissions.manage_guild
 
-    async def check_slowmode(self, message):
-        if message.guild is None:
+    def _update_slowmodes(self, guild_id):
+        config = self.slowmodes.get(guild_id)
+        if not config:
+            self._slowmodes.pop(guild_id, None)
             return
 
-        guild_id = message.guild.id
-        if guild_id not in self.slowmodes:
-            return
+        old = self._slowmodes.get(guild_id, {})
+        slowmodes = self._slowmodes[guild_id] = {}
+        for thing_id, slowmode in config.items():
+            thing_id = int(thing_id)
+            duration, no_immune = slowmode['duration'], slowmode['no_immune']
 
-        slowmodes = self.slowmodes[guild_id]
+            # Don't forget who spoke if the slowmode didn't actually change.
+            existing = old.get(thing_id)
+            if existing and (existing.duration, existing.no_immune) == (duration, no_immune):
+                slowmodes[thing_id] = existing
+            else:
+                slowmodes[thing_id] = _Slowmode(duration, no_immune)
+
+    def _queue_delete(self, message):
+        channel = message.channel
+        queue = self._deletion_queues.get(channel.id)
+        if queue is None:
+            queue = self._deletion_queues[channel.id] = _DeletionQueue(channel, loop=self.bot.loop)
+        queue.put(message)
+
+    def _has_slowmode(self, message, info):
+        return message.guild is not None and message.guild.id in self._slowmodes
+
+    async def check_slowmode(self, message, info=None):
+        if not self._has_slowmode(message, info):
+            return
 
+        slowmodes = self._slowmodes[message.guild.id]
         author = message.author
-        is_immune = self._is_slowmode_immune(author)
 
-        for thing in (message.channel, author):
-            key = str(thing.id)
-            if key not in slowmodes:
+        for thing_id in (message.channel.id, author.id):
+            slowmode = slowmodes.get(thing_id)
+            if slowmode is None:
                 continue
 
-            config = slowmodes[key]
-            if not config['no_immune'] and is_immune:
+            if not slowmode.no_immune and self._is_slowmode_immune(author):
                 continue
 
-            bucket = self.slowmode_bucket.setdefault(thing.id, {})
-            time = bucket.get(author.id)
-            if time is None or (message.created_at - time).total_seconds() >= config['duration']:
-                bucket[author.id] = message.created_at
-            else:
-                await message.delete()
+            if slowmode.is_limited(author.id, _message_time(message.id)):
+                self._queue_delete(message)
                 break
 
     @commands.group(invoke_without_command=True, usage=['15', '99999 @Mee6#4876'])
@@ -185,6 +364,7 @@ class Moderator(Cog):
 
         slowmode['duration'] = duration.duration
         await self.slowmodes.put(ctx.guild.id, config)
+        self._update_slowmodes(ctx.guild.id)
 
         await ctx.send(f'{member.mention} is now in slowmode! '
                        f'{pronoun} must wait {duration} '
@@ -200,14 +380,15 @@ class Moderator(Cog):
         will be deleted if they are within the duration given.
         """
         if member is None:
-            member, pronoun = ctx.channel, 'They'
+            member, pronoun = ctx.channel, 'Everyone'
         else:
-            pronoun = 'Everyone'
+            pronoun = 'They'
 
         config = self.slowmodes.get(ctx.guild.id, {})
-        slowmode = config.setdefault(str(member.id), {'no_immune': True})
-        slowmode['duration'] = duration.duration
-        await self.slowmodes.put(ctx.guild, config)
+        slowmode = config.setdefault(str(member.id), {})
+        slowmode.update(duration=duration.duration, no_immune=True)
+        await self.slowmodes.put(ctx.guild.id, config)
+        self._update_slowmodes(ctx.guild.id)
 
         await ctx.send(f'{member.mention} is now in **no-immune** slowmode! '
                        f'{pronoun} must wait {duration} '
@@ -224,7 +405,7 @@ class Moderator(Cog):
             return await ctx.send(f'{member.mention} was never in slowmode... \N{NEUTRAL FACE}')
         else:
             await self.slowmodes.put(ctx.guild.id, config)
-            self.slowmode_bucket.pop(member.id, None)
+            self._update_slowmodes(ctx.guild.id)
             await ctx.send(f'{member.mention} is no longer in slowmode... '
                            '\N{SMILING FACE WITH OPEN MOUTH AND COLD SWEAT}')
 
@@ -300,7 +481,7 @@ class Moderator(Cog):
         You can also use this if `{prefix}clear` fails.
         """
 
-        prefixes = tuple(ctx.bot.get_guild_prefixes(ctx.guild))
+        match_prefix = ctx.bot.get_prefix_matcher(ctx.guild).match
         bot_id = ctx.bot.user.id
 
         bot_perms = ctx.channel.permissions_for(ctx.me)
@@ -311,7 +492,7 @@ class Moderator(Cog):
             def is_possible_command_invoke(m):
                 if m.author.id == bot_id:
                     return True
-                return m.content.startswith(prefixes) and not m.content[1:2].isspace()
+                return match_prefix(m.content) and not m.content[1:2].isspace()
             deleted = await purge(check=is_possible_command_invoke)
         else:
             # We can only delete the bot's messages, because trying to delete
@@ -551,8 +732,8 @@ class Moderator(Cog):
         for channel in channels:
             await channel.set_permissions(role, **muted_permissions)
 
-    async def _do_mute(self, member, when):
-        mute_role = await self._setdefault_muted_role(member.guild)
+    async def _do_mute(self, member, when, *, role=None):
+        mute_role = role or await self._setdefault_muted_role(member.guild)
         if mute_role in member.roles:
             raise errors.InvalidUserArgument(f'{member.mention} is already been muted... ;-;')
 
@@ -596,48 +777,23 @@ class Moderator(Cog):
         # - Member was muted
         # - Mute role was changed while the user was muted
         # - Member was muted again with the new role.
-        query = """SELECT expires
-                   FROM schedule
-                   WHERE event = 'mute_complete'
-                   AND args_kwargs #>> '{args,0}' = $1
-                   AND args_kwargs #>> '{args,1}' = $2
-                   AND args_kwargs #>> '{args,2}' = $3
-                   LIMIT 1;
-                """
-
-        # We have to go to the lowest level possible, because simply using
-        # ctx.session.cursor WILL NOT work, as it uses str.format to format
-        # the parameters, which will throw a KeyError due to the {} in the
-        # JSON operators.
-        session = ctx.session.transaction.acquired_connection
-        entry = await session.fetchrow(query, str(ctx.guild.id), str(member.id), str(role.id))
-        if entry is None:
+        entries = await self.bot.db_scheduler.get_entries('mute_complete', ctx.guild.id, member.id, role.id, limit=1)
+        if not entries:
             return await ctx.send(f"{member} has been perm-muted, you must've "
                                   "added the role manually or something...")
 
-        when = entry['expires']
+        when = entries[0].time
         await ctx.send(f'{member} has {time.human_timedelta(when)} remaining. '
                        f'They will be unmuted on {when: %c}.')
 
-    async def _remove_time_entry(self, guild, member, session, *, event='mute_complete'):
-        query = """SELECT *
-                   FROM schedule
-                   WHERE event = $3
-                   AND args_kwargs #>> '{args,0}' = $1
-                   AND args_kwargs #>> '{args,1}' = $2
-                   ORDER BY expires
-                   LIMIT 1;
-                """
-        # We have to go to the lowest level possible, because simply using
-        # session.cursor WILL NOT work, as it uses str.format to format
-        # the parameters, which will throw a KeyError due to the {} in the
-        # JSON operators.
-        session = session.transaction.acquired_connection
-        entry = await session.fetchrow(query, str(guild.id), str(member.id), event)
-        if entry is None:
+    async def _remove_time_entry(self, guild, member, *, event='mute_complete'):
+        scheduler = self.bot.db_scheduler
+        entries = await scheduler.get_entries(event, guild.id, member.id, limit=1)
+        if not entries:
             return None
 
-        await self.bot.db_scheduler.remove(discord.Object(id=entry['id']))
+        entry = entries[0]
+        await scheduler.remove(entry)
         return entry
 
     @commands.command(usage=['@rjt#2336 sorry bb'])
@@ -649,7 +805,7 @@ class Moderator(Cog):
             return await ctx.send(f"{member} hasn't been muted!")
 
         await member.remove_roles(role)
-        await self._remove_time_entry(member.guild, member, ctx.session)
+        await self._remove_time_entry(member.guild, member)
         await ctx.send(f'{member.mention} can now speak again... '
                         '\N{SMILING FACE WITH OPEN MOUTH AND COLD SWEAT}')
 
@@ -736,24 +892,106 @@ class Moderator(Cog):
         """Unbans the user (obviously)"""
 
         await ctx.guild.unban(user.user)
-        await self._remove_time_entry(ctx.guild, user, ctx.session, event='tempban_complete')
+        await self._remove_time_entry(ctx.guild, user.user, event='tempban_complete')
         await ctx.send(f"Done. What did {user.user} do to get banned in the first place...?")
 
+    async def _mass_action(self, ctx, members, action, *, done, cache_name=None):
+        """Applies an action to a bunch of members, a few at a time.
+
+        The progress message gets updated every now and then, so people aren't
+        left wondering if anything is happening during a raid.
+
+        Returns the members the action actually worked on.
+        """
+        # Don't want to ban the same guy twice.
+        members = list({m.id: m for m in members}.values())
+
+        mod_log = ctx.bot.get_cog('ModLog')
+        semaphore = asyncio.Semaphore(MASS_ACTION_CONCURRENCY)
+        succeeded, failed = [], []
+
+        async def apply(member):
+            async with semaphore:
+                try:
+                    # One bad target (like the mod themselves) shouldn't
+                    # stop the action for everyone else.
+                    self._check_user(ctx, member)
+
+                    if mod_log and cache_name:
+                        # Otherwise the mod-log would make a case for every
+                        # single member when it polls the audit log.
+                        mod_log.add_to_cache(cache_name, ctx.guild.id, member.id)
+
+                    await action(member)
+                except (discord.HTTPException, errors.InvalidUserArgument):
+                    failed.append(member)
+                else:
+                    succeeded.append(member)
+
+        def progress():
+            return f'{done} {len(succeeded) + len(failed)}/{len(members)} members...'
+
+        message = await ctx.send(progress())
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(MASS_ACTION_PROGRESS_INTERVAL)
+                with contextlib.suppress(discord.HTTPException):
+                    await message.edit(content=progress())
+
+        reporter = ctx.bot.loop.create_task(report_progress())
+        try:
+            await asyncio.gather(*map(apply, members))
+        finally:
+            reporter.cancel()
+
+        content = f'{done} {len(succeeded)}/{len(members)} members.'
+        if failed:
+            content += (f"\nCouldn't get to {len(failed)} of them though. "
+                        "Maybe they're just too powerful for me...")
+
+        with contextlib.suppress(discord.HTTPException):
+            await message.edit(content=content)
+
+        succeeded = await asyncio.gather(*(_resolve_user(ctx.bot, m) for m in succeeded))
+        ctx.mod_targets = succeeded = list(succeeded)
+        return succeeded
+
     @commands.command(usage='"theys f-ing up shit" @user1#0000 105635576866156544 user2#0001 user3')
     @commands.has_permissions(ban_members=True)
     async def massban(self, ctx, reason, *members: MemberID):
         """Bans multiple users from the server (obviously)"""
-        for m in members:
-            await ctx.guild.ban(m, reason=reason)
-
+        ban = functools.partial(ctx.guild.ban, reason=reason)
+        await self._mass_action(ctx, members, ban, done='Banned', cache_name='ban')
         await ctx.send(f"Done. What happened...?")
 
-    mute._required_perms    = 'Manage Roles'
-    unmute._required_perms  = 'Manage Roles'
-    kick._required_perms    = 'Kick Members'
-    for cmd in (softban, tempban, ban, unban):
+    @commands.command(usage='"raiding" @user1#0000 @user2#0001 user3')
+    @commands.has_permissions(kick_members=True)
+    async def masskick(self, ctx, reason, *members: discord.Member):
+        """Kicks multiple users from the server (obviously)"""
+        kick = functools.partial(ctx.guild.kick, reason=reason)
+        await self._mass_action(ctx, members, kick, done='Kicked', cache_name='kick')
+        await ctx.send(f"Done. Please don't make me do that again...")
+
+    @commands.command(usage='"spamming" 1h @user1#0000 @user2#0001 user3')
+    @commands.has_permissions(manage_messages=True)
+    async def massmute(self, ctx, reason, duration: time.Delta, *members: discord.Member):
+        """Mutes multiple users (obviously)"""
+        # Otherwise every mute would look up (or even make) the muted role.
+        role = await self._setdefault_muted_role(ctx.guild)
+
+        when = ctx.message.created_at + duration.delta
+        mute = functools.partial(self._do_mute, when=when, role=role)
+        await self._mass_action(ctx, members, mute, done='Muted')
+        await ctx.send(f"Done. They'll be muted for {duration}... \N{ZIPPER-MOUTH FACE}")
+
+    for cmd in (mute, unmute, massmute):
+        cmd._required_perms = 'Manage Roles'
+    for cmd in (kick, masskick):
+        cmd._required_perms = 'Kick Members'
+    for cmd in (softban, tempban, ban, unban, massban):
         cmd._required_perms = 'Ban Members'
-    del cmd     # cmd still exists outside the for loop, (which is named as unban...)
+    del cmd     # cmd still exists outside the for loop, (which is named as massban...)
 
     @mute.error
     @unmute.error
@@ -763,6 +1001,8 @@ class Moderator(Cog):
     @ban.error
     @unban.error
     @massban.error
+    @masskick.error
+    @massmute.error
     async def mod_action_error(self, ctx, error):
         # We need to use the __cause__ because any non-CommandErrors will be
         # wrapped in CommandInvokeError
@@ -777,9 +1017,6 @@ class Moderator(Cog):
 
     # --------- Events ---------
 
-    async def on_message(self, message):
-        await self.check_slowmode(message)
-
     async def on_guild_channel_create(self, channel):
         server = channel.guild
 
@@ -795,11 +1032,10 @@ class Moderator(Cog):
 
     async def on_member_join(self, member):
         # Prevent mute-evasion
-        async with self.bot.db.get_session() as session:
-            entry = await self._remove_time_entry(member.guild, member, session)
-            if entry:
-                # mute them for an extra 60 mins
-                await self._do_mute(member, entry['expires'] + datetime.timedelta(seconds=3600))
+        entry = await self._remove_time_entry(member.guild, member)
+        if entry:
+            # mute them for an extra 60 mins
+            await self._do_mute(member, entry.time + datetime.timedelta(seconds=3600))
 
     async def on_member_update(self, before, after):
         # In the event of a manual unmute, this has to be covered.
@@ -809,12 +1045,11 @@ class Moderator(Cog):
 
         role = await self._get_muted_role(before.guild)
         if role in removed_roles:
-            async with self.bot.db.get_session() as session:
-                # We need to remove this guy from the scheduler in the event of
-                # a manual unmute. Because if the guy was muted again, the old
-                # mute would still be in effect. So it would just remove the
-                # muted role.
-                await self._remove_time_entry(before.guild, before, session)
+            # We need to remove this guy from the scheduler in the event of
+            # a manual unmute. Because if the guy was muted again, the old
+            # mute would still be in effect. So it would just remove the
+            # muted role.
+            await self._remove_time_entry(before.guild, before)
 
     # XXX: Should I even bother to remove unbans from the scheduler in the event
     #      of a manual unban?
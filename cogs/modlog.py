@@ -6,6 +6,7 @@ import discord
 import enum
 import json
 import logging
+import math
 import operator
 
 from datetime import datetime, timedelta
@@ -36,6 +37,12 @@ class Case(TableBase, table_name='modlog'):
     guild_id = asyncqlio.Column(asyncqlio.BigInt)
     modlog_guild_id_idx = asyncqlio.Index(guild_id)
 
+    # The case number within the guild, so that looking up case #N doesn't
+    # have to go through the first N-1 cases. The (guild_id, case_number)
+    # index is made in ModLog._migrate rather than here, because the column
+    # might not exist yet when the tables get created.
+    case_number = asyncqlio.Column(asyncqlio.Integer, nullable=True)
+
     action = asyncqlio.Column(asyncqlio.String(16))
     mod_id = asyncqlio.Column(asyncqlio.BigInt)
     reason = asyncqlio.Column(asyncqlio.String(1024))
@@ -65,8 +72,14 @@ _mod_actions = {
     'unban'   : ModAction('unbanned', '\N{DOVE OF PEACE}', 0x43A047),
     'hackban' : ModAction('prematurely banned', '\N{NO ENTRY}', 0x212121),
     'massban' : ModAction('massbanned', '\N{NO ENTRY}', 0xb71c1c),
+    'masskick': ModAction('masskicked', '\N{WOMANS BOOTS}', 0xE65100),
+    'massmute': ModAction('massmuted', '\N{SPEAKER WITH CANCELLATION STROKE}', 0x212121),
 }
 
+# These take the reason as a required positional argument, and can have
+# more than one target.
+_mass_actions = {'massban', 'masskick', 'massmute'}
+
 
 class EnumConverter(enum.IntFlag):
     """Mixin used for converting enums"""
@@ -81,6 +94,19 @@ class EnumConverter(enum.IntFlag):
 ActionFlag = enum.IntFlag('ActionFlag', list(_mod_actions), type=EnumConverter)
 _default_flags = (2 ** len(_mod_actions) - 1) & ~ActionFlag.hackban
 
+# Flags that were added after configs were already being saved, and the
+# flag they should follow in those configs.
+_added_flags = {
+    ActionFlag.masskick: ActionFlag.kick,
+    ActionFlag.massmute: ActionFlag.mute,
+}
+
+def _add_new_flags(events):
+    for new, old in _added_flags.items():
+        if events & old:
+            events |= new
+    return int(events)
+
 
 for k, v in list(_mod_actions.items()):
     _mod_actions[f'auto-{k}'] = v._replace(repr=f'auto-{v.repr}')
@@ -101,12 +127,20 @@ class ModLogConfig(TableBase, table_name='modlog_config'):
 
     events = asyncqlio.Column(asyncqlio.Integer, default=_default_flags)
 
+    # The number of cases in the guild. This is bumped in the same transaction
+    # as the case gets inserted, so it's always the latest case number.
+    case_count = asyncqlio.Column(asyncqlio.Integer, default=0)
+
+
+def _target_str(target):
+    return str(target) if isinstance(target, discord.abc.User) else str(target.id)
+
 
 def _is_mod_action(ctx):
     return ctx.command.qualified_name in _mod_actions
 
 
-@cache.cache(maxsize=512)
+@cache.cache(maxsize=512, ttl=600, negative_ttl=60)
 async def _get_message(channel, message_id):
     o = discord.Object(id=message_id + 1)
     # don't wanna use get_message due to poor rate limit (1/1s) vs (50/1s)
@@ -117,14 +151,35 @@ async def _get_message(channel, message_id):
 
     return msg
 
-@cache.cache(maxsize=None, make_key=lambda a, kw: a[-1])
+@cache.cache(maxsize=2048, ttl=3600, make_key=lambda a, kw: a[-1])
 async def _get_number_of_cases(session, guild_id):
-    query = "SELECT COUNT(*) FROM modlog WHERE guild_id={guild_id};"
+    query = "SELECT case_count FROM modlog_config WHERE guild_id={guild_id};"
     params = {'guild_id': guild_id}
     result = await session.cursor(query, params)
     row = await result.fetch_row()
 
-    return row['count']
+    return row['case_count'] if row else 0
+
+
+async def _bump_number_of_cases(session, guild_id):
+    # The row stays locked until the transaction is done, so two cases
+    # being made at the same time can't end up with the same number.
+    query = """UPDATE modlog_config SET case_count = COALESCE(case_count, 0) + 1
+               WHERE guild_id = {guild_id}
+               RETURNING case_count;
+            """
+    params = {'guild_id': guild_id}
+    result = await session.cursor(query, params)
+    row = await result.fetch_row()
+    if row is None:
+        # The config must've been deleted while the case was being made.
+        raise ModLogError("This server doesn't have a mod-log set up anymore.")
+
+    # Keep the cache in sync, rather than invalidating it and having to
+    # query it again later.
+    count = row['case_count']
+    _get_number_of_cases.cache[guild_id] = count
+    return count
 
 
 class CaseNumber(commands.Converter):
@@ -144,15 +199,208 @@ class CaseNumber(commands.Converter):
         return num
 
 
+class _AuditLogWaiter:
+    __slots__ = ('future', 'after', 'attempts')
+
+    def __init__(self, future, after):
+        self.future = future
+        self.after = after
+        self.attempts = 0
+
+
+class _AuditLogPoller:
+    """Polls a guild's audit log for a bunch of members at once.
+
+    Polling the audit log separately for every member during a raid or
+    a mass-ban is a *lot* of requests. Instead, everyone waiting on the
+    same action is resolved from the same fetch of the audit log.
+    """
+    # How long to let events pile up before polling. This also gives Discord
+    # some time to actually add the entry. It shouldn't take too long... Right, Discord?
+    WINDOW = 1
+    MAX_ATTEMPTS = 3
+    # How long to back off for if something went wrong (e.g. we got rate-limited).
+    BACKOFF = 5
+
+    def __init__(self, guild, stats, *, loop):
+        self.guild = guild
+        self.stats = stats
+        self._loop = loop
+        # action -> {user_id: _AuditLogWaiter}
+        self._waiters = collections.defaultdict(dict)
+        self._task = None
+
+    def __bool__(self):
+        return bool(self._waiters)
+
+    def wait_for(self, action, user):
+        """Returns the audit log entry for the action on the user, or None
+        if it never showed up.
+        """
+        self.stats['requests'] += 1
+
+        waiters = self._waiters[action]
+        waiter = waiters.get(user.id)
+        if waiter is None:
+            # We'll try to be generous with delays because discord is a good service:tm:
+            # Seriously some guilds might have large latency with audit logs, meaning the
+            # could've added the entry way before the event is called.
+            after = datetime.utcnow() - timedelta(seconds=2)
+            waiter = waiters[user.id] = _AuditLogWaiter(self._loop.create_future(), after)
+
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+        return asyncio.shield(waiter.future)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        delay = self.WINDOW
+        try:
+            while self._waiters:
+                await asyncio.sleep(delay)
+                delay = self.WINDOW
+
+                for action in list(self._waiters):
+                    try:
+                        await self._poll(action)
+                    except discord.Forbidden:
+                        # Can't see the audit log anymore, so there's no point.
+                        self._give_up(action, self._waiters.pop(action))
+                    except discord.HTTPException as e:
+                        log.warning('Polling the audit log in %s (ID: %d) failed: %r',
+                                    self.guild, self.guild.id, e)
+                        self.stats['errors'] += 1
+                        delay = self.BACKOFF
+        finally:
+            self._task = None
+            for action, waiters in self._waiters.items():
+                self._give_up(action, waiters)
+            self._waiters.clear()
+
+    def _give_up(self, action, waiters):
+        for user_id, waiter in waiters.items():
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+
+            log.info('User ID %d in guild %s (ID: %d) never had an entry for event %r',
+                     user_id, self.guild, self.guild.id, action)
+
+        self.stats['gave up'] += len(waiters)
+
+    async def _poll(self, action):
+        waiters = self._waiters[action]
+        waiting = len(waiters)
+        for waiter in waiters.values():
+            waiter.attempts += 1
+
+        after = min(waiter.after for waiter in waiters.values())
+        audit_action = discord.AuditLogAction[action]
+
+        fetched = 0
+        try:
+            async for entry in self.guild.audit_logs(action=audit_action, after=after, limit=None):
+                fetched += 1
+                waiter = waiters.pop(getattr(entry.target, 'id', None), None)
+                if waiter is not None and not waiter.future.done():
+                    waiter.future.set_result(entry)
+
+                if not waiters:
+                    break
+        finally:
+            # Audit logs are fetched 100 at a time.
+            calls = max(1, math.ceil(fetched / 100))
+            self.stats['http calls'] += calls
+            # This is how many calls it would've been if every member was polled separately.
+            self.stats['http calls saved'] += max(0, waiting - calls)
+
+        gave_up = {user_id: waiter for user_id, waiter in waiters.items()
+                   if waiter.attempts >= self.MAX_ATTEMPTS}
+        for user_id in gave_up:
+            del waiters[user_id]
+        self._give_up(action, gave_up)
+
+        if not waiters:
+            self._waiters.pop(action, None)
+
+
+async def _add_column(connection, table, column, type):
+    # Returns True if the column had to be added.
+    query = """SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                              WHERE table_name = $1 AND column_name = $2);
+            """
+    if await connection.fetchval(query, table, column):
+        return False
+
+    await connection.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {type};')
+    return True
+
+
 class ModLog(Cog):
     def __init__(self, bot):
         self.bot = bot
+        self._migration = bot.loop.create_task(self._migrate())
         self._cache_cleaner = asyncio.ensure_future(self._clean_cache())
         self._cache_locks = collections.defaultdict(asyncio.Event)
         self._cache = set()
 
+        self._audit_log_pollers = {}
+        # requests, http calls, http calls saved, gave up, errors
+        self.audit_log_stats = collections.Counter()
+
     def __unload(self):
+        self._migration.cancel()
         self._cache_cleaner.cancel()
+        for poller in self._audit_log_pollers.values():
+            poller.cancel()
+
+    async def _migrate(self):
+        # Waiting until the bot's ready so that this doesn't race with
+        # --create-tables, which has to make the tables first.
+        await self.bot.wait_until_ready()
+
+        async with self.bot.db.get_session() as session:
+            conn = session.transaction.acquired_connection
+
+            if await _add_column(conn, 'modlog', 'case_number', 'INTEGER'):
+                # Case #N used to be the Nth case in the guild ordered by ID,
+                # so the numbers have to be filled in the same way.
+                log.info('Adding case numbers to existing cases...')
+                await conn.execute("""
+                    UPDATE modlog
+                    SET case_number = numbered.n
+                    FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY guild_id ORDER BY id) AS n
+                          FROM modlog) AS numbered
+                    WHERE modlog.id = numbered.id AND modlog.case_number IS NULL;
+                """)
+
+            await conn.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS modlog_guild_case_number_idx
+                ON modlog (guild_id, case_number);
+            """)
+
+            if await _add_column(conn, 'modlog_config', 'case_count', 'INTEGER DEFAULT 0'):
+                log.info('Filling in the case counts...')
+                await conn.execute("""
+                    UPDATE modlog_config
+                    SET case_count = COALESCE((SELECT MAX(case_number) FROM modlog
+                                               WHERE modlog.guild_id = modlog_config.guild_id), 0);
+                """)
+
+                # masskick and massmute came in at the same time as the case
+                # counts, so none of these configs have those flags yet.
+                records = await conn.fetch('SELECT guild_id, events FROM modlog_config;')
+                updates = [(guild_id, _add_new_flags(events)) for guild_id, events in records]
+                query = 'UPDATE modlog_config SET events = $2 WHERE guild_id = $1;'
+                await conn.executemany(query, [u for u, r in zip(updates, records) if u[1] != r[1]])
+
+    async def __local_check(self, ctx):
+        # Every command here touches the case numbers or counts one way or another.
+        await asyncio.shield(self._migration)
+        return True
 
     async def _clean_cache(self):
         # Used to clear the message cache every now and then
@@ -184,29 +432,47 @@ class ModLog(Cog):
         if auto:
             action = f'auto-{action}'
 
-        # Get the case number, this is why the guild_id is indexed.
-        count = await _get_number_of_cases(session, server.id)
+        await asyncio.shield(self._migration)
 
-        # Send the case like normal
-        embed = self._create_embed(count + 1, action, mod, targets, reason, extra)
+        # Reserve the case number. This is in the same transaction as the case
+        # itself, so if that doesn't get made the number goes back with it.
+        # The savepoint is for when sending fails, because the session still
+        # gets committed after a ModLogError.
+        #
+        # This does mean cases in the same guild are made one at a time, as
+        # the config row stays locked until the transaction's done.
+        await session.execute('SAVEPOINT modlog_case_number;')
+        number = await _bump_number_of_cases(session, server.id)
 
         try:
-            message = await channel.send(embed=embed)
-        except discord.Forbidden:
-            raise ModLogError(f"I can't send messages to {channel.mention}. Check my privileges pls...")
-
-        # Add the case to the DB, because mod-logging was successful!
-        row = await session.add(Case(
-            guild_id=server.id,
-            channel_id=channel.id,
-            message_id=message.id,
-
-            action=action,
-            mod_id=mod.id,
-            reason=reason,
-            extra=json.dumps({'args': [extra]})
-
-        ))
+            # Send the case like normal
+            embed = self._create_embed(number, action, mod, targets, reason, extra)
+
+            try:
+                message = await channel.send(embed=embed)
+            except discord.HTTPException as e:
+                await session.execute('ROLLBACK TO SAVEPOINT modlog_case_number;')
+                if isinstance(e, discord.Forbidden):
+                    raise ModLogError(f"I can't send messages to {channel.mention}. Check my privileges pls...")
+                raise
+
+            # Add the case to the DB, because mod-logging was successful!
+            row = await session.add(Case(
+                guild_id=server.id,
+                case_number=number,
+                channel_id=channel.id,
+                message_id=message.id,
+
+                action=action,
+                mod_id=mod.id,
+                reason=reason,
+                extra=json.dumps({'args': [extra]})
+
+            ))
+        except BaseException:
+            # The bump didn't stick, so the cached count is wrong now.
+            _get_number_of_cases.invalidate(server.id)
+            raise
 
         return row.id
 
@@ -214,7 +480,11 @@ class ModLog(Cog):
         time = time or datetime.utcnow()
         action = _mod_actions[action]
 
-        avatar_url = targets[0].avatar_url if len(targets) == 1 else MASSBAN_THUMBNAIL
+        if len(targets) == 1:
+            # Targets can still be a discord.Object if the user couldn't be found.
+            avatar_url = getattr(targets[0], 'avatar_url', MASSBAN_THUMBNAIL)
+        else:
+            avatar_url = MASSBAN_THUMBNAIL
         bot_avatar = self.bot.user.avatar_url
 
         duration_string = f' for {duration_units(extra)}' if extra is not None else ''
@@ -224,17 +494,13 @@ class ModLog(Cog):
         return (discord.Embed(color=action.colour, timestamp=time)
                 .set_author(name=f"Case #{number}", icon_url=emoji_url(action.emoji))
                 .set_thumbnail(url=avatar_url)
-                .add_field(name=f'User{"s" * (len(targets) != 1)}', value=', '.join(map(str, targets)))
+                .add_field(name=f'User{"s" * (len(targets) != 1)}', value=', '.join(map(_target_str, targets)))
                 .add_field(name="Action", value=action_field, inline=False)
                 .add_field(name="Reason", value=reason, inline=False)
                 .set_footer(text=f'ID: {mod.id}', icon_url=bot_avatar)
                 )
 
     async def _insert_case(self, session, action, server, mod, targets, reason, extra, entry_id):
-        # Because we've successfully added a new case by this point,
-        # the number of cases is no longer accurate.
-        _get_number_of_cases.invalidate(None, server.id)
-
         if len(targets) == 1:
             await session.add(CaseTarget(entry_id=entry_id, user_id=targets[0].id))
         else:
@@ -245,14 +511,14 @@ class ModLog(Cog):
 
     async def _notify_user(self, config, action, server, user, targets, reason, 
                            extra=None, auto=False):
-        if action == 'massban':
+        if action in _mass_actions:
             # XXX: Should I DM users who were massbanned?
             return
 
         if config and not config.dm_user:
             return
 
-        # Should always be true because we're not DMing users in a massban.
+        # Should always be true because we're not DMing users in a mass action.
         assert len(targets) == 1, f'too many targets for {action}'
 
         mod_action = _mod_actions[action]
@@ -288,6 +554,12 @@ class ModLog(Cog):
 
         self.bot.loop.create_task(delete_value())
 
+    # Invoked by the mod-cog during mass actions. Those can take a lot longer
+    # than the cache from mod_before_invoke lasts, so every member has to be
+    # put in the cache right before the action is applied to them.
+    def add_to_cache(self, name, guild_id, member_id):
+        self._add_to_cache(name, guild_id, member_id)
+
     # Invoked by the mod-cog, this is used to wait for the cache during
     # tempban and mute completion.
     def wait_for_cache(self, name, guild_id, member_id):
@@ -318,14 +590,20 @@ class ModLog(Cog):
         if ctx.command_failed:
             return
 
-        targets = [m for m in ctx.args if isinstance(m, discord.Member)]
+        # Mass actions only log the members the action actually worked on.
+        targets = getattr(ctx, 'mod_targets', None)
+        if targets is None:
+            targets = [m for m in ctx.args if isinstance(m, discord.Member)]
+        if not targets:
+            return
+
         # Will be set by warn in the event of auto-punishment
         auto = getattr(ctx, 'auto_punished', False)
         # For mutes and tempbans.
         extra = ctx.args[3] if 'duration' in ctx.command.params else None
-        # In the event of a massban, the reason is a required positional argument
+        # In the event of a mass action, the reason is a required positional argument
         # rather than a keyword-only consume rest one.
-        reason = ctx.args[2] if name == 'massban' else ctx.kwargs.get('reason')
+        reason = ctx.args[2] if name in _mass_actions else ctx.kwargs.get('reason')
 
         # We have get the config outside the two functions because we use it twice.
         config = await self._get_case_config(ctx.session, ctx.guild.id)
@@ -365,39 +643,23 @@ class ModLog(Cog):
 
         # poll the audit log for some nice shit
         # XXX: This doesn't catch softbans.
-        audit_action = discord.AuditLogAction[action]
-
-        # We'll try to be generous with delays because discord is a good service:tm:
-        # Seriously some guilds might have large latency with audit logs, meaning the
-        # could've added the entry way before the event is called.
-        after = datetime.utcnow() - timedelta(seconds=2)
+        poller = self._audit_log_pollers.get(guild.id)
+        if poller is None:
+            poller = _AuditLogPoller(guild, self.audit_log_stats, loop=self.bot.loop)
+            self._audit_log_pollers[guild.id] = poller
 
         try:
-            for attempt in range(3):
-                # This delay is here for two reasons:
-                # 1. We want to avoid rate-limiting the bot too hard.
-                # 2. We'll wait for long periods of time so that we can sufficiently
-                #    wait for the audit log entry to be added, we don't know what
-                #    the delay is, but we'll take a best guess
-                #
-                # It shouldn't take too long... Right, Discord?
-                await asyncio.sleep(0.5 * (attempt + 1))  # cruddy backoff
-
-                entry = await guild.audit_logs(action=audit_action, after=after).get(target=user)
-                if entry is not None:
-                    break
-
-            else:  # hooray for for-else
-                log.info('%s (ID: %d) in guild %s (ID: %d) never had an entry for event %r',
-                         user, user.id, guild, guild.id, action)
-                # We should just give up here. Because we need a non-None entry,
-                # and in the case of member_remove, the member could've just up
-                # and left the server, which means it won't make sense for it to
-                # be logged.
-                return
-
-        except discord.Forbidden:
-            return  # should not happen but this is here just in case it happens
+            entry = await poller.wait_for(action, user)
+        finally:
+            if not poller and self._audit_log_pollers.get(guild.id) is poller:
+                del self._audit_log_pollers[guild.id]
+
+        if entry is None:
+            # We should just give up here. Because we need a non-None entry,
+            # and in the case of member_remove, the member could've just up
+            # and left the server, which means it won't make sense for it to
+            # be logged.
+            return
 
         with contextlib.suppress(ModLogError):
             async with self.bot.db.get_session() as session:
@@ -426,10 +688,7 @@ class ModLog(Cog):
 
     async def _get_case(self, session, guild_id, num):
         query = (session.select.from_(Case)
-                        .where(Case.guild_id == guild_id)
-                        .order_by(Case.id)
-                        .offset(num - 1)
-                        .limit(1)
+                        .where((Case.guild_id == guild_id) & (Case.case_number == num))
                  )
         return await query.first()
 
@@ -134,7 +134,7 @@ PRE_PING_REMARKS = [
 TEN_SEC_REACTION = '\N{BLACK SQUARE FOR STOP}'
 
 
-class OtherStuffs(Cog):
+class OtherStuffs(Cog, needs_db=False):
     def __init__(self, bot):
         self.bot = bot
         self.default_time = datetime.utcnow()
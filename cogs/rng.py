@@ -143,7 +143,7 @@ _available_distributions = {
     'triangular': random.triangular,
     }
 
-class RNG(Cog):
+class RNG(Cog, needs_db=False):
     __aliases__ = "Random",
 
     def __init__(self, bot):
@@ -1,8 +1,12 @@
 import aiohttp
+import asyncio
 import asyncqlio
+import collections
+import contextlib
 import discord
 import datetime
 import itertools
+import logging
 import math
 import psutil
 import traceback
@@ -20,6 +24,8 @@ from .utils.time import human_timedelta
 
 from core.cog import Cog
 
+log = logging.getLogger(__name__)
+
 _ignored_exceptions = (
     commands.NoPrivateMessage,
     commands.DisabledCommand,
@@ -43,10 +49,64 @@ class Command(TableBase, table_name='commands'):
     commands_author_id_idx = asyncqlio.Index(author_id)
 
     used = asyncqlio.Column(asyncqlio.Timestamp)
+    # For looking up someone's latest commands (i.e. history)
+    commands_author_id_used_idx = asyncqlio.Index(author_id, used)
     prefix = asyncqlio.Column(asyncqlio.String)
     command = asyncqlio.Column(asyncqlio.String, index=True)
     commands_command_idx = asyncqlio.Index(command)
 
+# The order of the columns for the COPY
+_command_columns = ('guild_id', 'channel_id', 'author_id', 'used', 'prefix', 'command')
+
+
+# Rollups of the commands table, so that the top commands don't have to go
+# through the entire history every time. These are updated whenever the
+# pending commands are flushed.
+
+class CommandUsage(TableBase, table_name='command_usage'):
+    command = asyncqlio.Column(asyncqlio.String, primary_key=True)
+    uses = asyncqlio.Column(asyncqlio.BigInt, default=0)
+
+
+class GuildCommandUsage(TableBase, table_name='guild_command_usage'):
+    guild_id = asyncqlio.Column(asyncqlio.BigInt, primary_key=True)
+    command = asyncqlio.Column(asyncqlio.String, primary_key=True)
+    uses = asyncqlio.Column(asyncqlio.BigInt, default=0)
+
+
+class DailyCommandUsage(TableBase, table_name='daily_command_usage'):
+    # Always midnight (UTC) of the day.
+    day = asyncqlio.Column(asyncqlio.Timestamp, primary_key=True)
+    command = asyncqlio.Column(asyncqlio.String, primary_key=True)
+    uses = asyncqlio.Column(asyncqlio.BigInt, default=0)
+
+
+def _day(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def _update_rollups(conn, records):
+    by_command = collections.Counter(r[-1] for r in records)
+    by_guild = collections.Counter((r[0], r[-1]) for r in records if r[0] is not None)
+    by_day = collections.Counter((_day(r[3]), r[-1]) for r in records)
+
+    await conn.executemany("""INSERT INTO command_usage (command, uses) VALUES ($1, $2)
+                              ON CONFLICT (command)
+                              DO UPDATE SET uses = command_usage.uses + EXCLUDED.uses;
+                           """, list(by_command.items()))
+
+    await conn.executemany("""INSERT INTO guild_command_usage (guild_id, command, uses)
+                              VALUES ($1, $2, $3)
+                              ON CONFLICT (guild_id, command)
+                              DO UPDATE SET uses = guild_command_usage.uses + EXCLUDED.uses;
+                           """, [(*k, v) for k, v in by_guild.items()])
+
+    await conn.executemany("""INSERT INTO daily_command_usage (day, command, uses)
+                              VALUES ($1, $2, $3)
+                              ON CONFLICT (day, command)
+                              DO UPDATE SET uses = daily_command_usage.uses + EXCLUDED.uses;
+                           """, [(*k, v) for k, v in by_day.items()])
+
 
 # These functions are usually used for doing ratings
 # but here I'm using them to calculate if a server *might*
@@ -89,26 +149,83 @@ def _ci_lower_bound(pos, n, confidence):
 
 
 class Stats(Cog):
+    # Commands are logged in batches rather than one transaction per command.
+    # The batch is flushed once it hits COMMAND_BATCH_SIZE, or every
+    # COMMAND_FLUSH_INTERVAL seconds, whichever comes first.
+    COMMAND_BATCH_SIZE = 100
+    COMMAND_FLUSH_INTERVAL = 10
+    # If the DB is down we don't want this to grow forever. Anything
+    # past this gets dropped (and counted).
+    MAX_PENDING_COMMANDS = 10000
+
     def __init__(self, bot):
         self.bot = bot
         self.process = psutil.Process()
 
+        self._pending_commands = []
+        self._command_flush_lock = asyncio.Lock()
+        self._command_batch_full = asyncio.Event()
+        # queued, flushed, dropped, flushes, failed flushes
+        self.command_log_stats = collections.Counter()
+        self._command_flusher = bot.loop.create_task(self._flush_commands_periodically())
+
+    def __unload(self):
+        self._command_flusher.cancel()
+        self.bot.loop.create_task(self.flush_commands())
+
+    async def on_shutdown(self):
+        self._command_flusher.cancel()
+        await self.flush_commands()
+
+    async def _flush_commands_periodically(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._command_batch_full.wait(), self.COMMAND_FLUSH_INTERVAL)
+            self._command_batch_full.clear()
+            await self.flush_commands()
+
+    async def flush_commands(self):
+        """Writes all the pending commands to the DB in one COPY."""
+        async with self._command_flush_lock:
+            records, self._pending_commands = self._pending_commands, []
+            if not records:
+                return
+
+            try:
+                # The rollups are updated in the same transaction, so they
+                # can't go out of sync with the actual commands table.
+                async with self.bot.db.get_session() as session:
+                    conn = session.transaction.acquired_connection
+                    await conn.copy_records_to_table('commands', columns=_command_columns, records=records)
+                    await _update_rollups(conn, records)
+            except Exception:
+                log.exception('Failed to log %d commands', len(records))
+                self.command_log_stats['failed flushes'] += 1
+
+                # Put them back so they can be tried again next time, as
+                # long as that doesn't go over the limit.
+                room = max(0, self.MAX_PENDING_COMMANDS - len(self._pending_commands))
+                self._pending_commands[:0] = records[-room:] if room else []
+                self.command_log_stats['dropped'] += len(records) - min(room, len(records))
+            else:
+                self.command_log_stats['flushes'] += 1
+                self.command_log_stats['flushed'] += len(records)
+
     async def on_command(self, ctx):
         command = ctx.command.qualified_name
         self.bot.command_leaderboard[command] += 1
 
+        if len(self._pending_commands) >= self.MAX_PENDING_COMMANDS:
+            self.command_log_stats['dropped'] += 1
+            return
+
         guild_id = None if ctx.guild is None else ctx.guild.id
-        row = Command(
-            guild_id=guild_id,
-            channel_id=ctx.channel.id,
-            author_id=ctx.author.id,
-            used=ctx.message.created_at,
-            prefix=ctx.prefix,
-            command=command,
-        )
+        record = (guild_id, ctx.channel.id, ctx.author.id, ctx.message.created_at, ctx.prefix, command)
+        self._pending_commands.append(record)
+        self.command_log_stats['queued'] += 1
 
-        async with ctx.db.get_session() as s:
-            await s.add(row)
+        if len(self._pending_commands) >= self.COMMAND_BATCH_SIZE:
+            self._command_batch_full.set()
 
     async def _show_top_commands(self, ctx, n, entries):
         padding = int(math.log10(n)) + 1
@@ -127,31 +244,72 @@ class Stats(Cog):
     @top_commands.group(name='alltime', aliases=['all'])
     async def top_commands_alltime(self, ctx, n=10):
         """Shows the top n commands of all time, globally."""
-        query = """SELECT command,
-                          COUNT(*) as "uses"
-                   FROM commands
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT {n};
-                """
-        results = await (await ctx.session.cursor(query, {'n': n})).flatten()
-        await self._show_top_commands(ctx, n, (r.values() for r in results))
+        query = (ctx.session.select.from_(CommandUsage)
+                            .order_by(CommandUsage.uses, sort_order='desc')
+                            .limit(n)
+                 )
+        results = [(row.command, row.uses) async for row in await query.all()]
+        await self._show_top_commands(ctx, n, results)
 
     @top_commands.group(name='alltimeserver', aliases=['allserver'])
+    @commands.guild_only()
     async def top_commands_alltimeserver(self, ctx, n=10):
         """Shows the top n commands of all time, in the server."""
-        query = """SELECT command,
-                          COUNT(*) as "uses"
-                   FROM commands
-                   WHERE guild_id = {guild_id}
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT {n};
-                """
-        params = {'n': n, 'guild_id': ctx.guild.id}
-        results = await (await ctx.session.cursor(query, params)).flatten()
-        print(results)
-        await self._show_top_commands(ctx, n, (tuple(r.values()) for r in results))
+        query = (ctx.session.select.from_(GuildCommandUsage)
+                            .where(GuildCommandUsage.guild_id == ctx.guild.id)
+                            .order_by(GuildCommandUsage.uses, sort_order='desc')
+                            .limit(n)
+                 )
+        results = [(row.command, row.uses) async for row in await query.all()]
+        await self._show_top_commands(ctx, n, results)
+
+    @top_commands.group(name='today')
+    async def top_commands_today(self, ctx, n=10):
+        """Shows the top n commands today (UTC), globally."""
+        query = (ctx.session.select.from_(DailyCommandUsage)
+                            .where(DailyCommandUsage.day == _day(datetime.datetime.utcnow()))
+                            .order_by(DailyCommandUsage.uses, sort_order='desc')
+                            .limit(n)
+                 )
+        results = [(row.command, row.uses) async for row in await query.all()]
+        await self._show_top_commands(ctx, n, results)
+
+    @top_commands.command(name='backfill', hidden=True)
+    @commands.is_owner()
+    async def top_commands_backfill(self, ctx):
+        """Rebuilds the command usage rollups from the entire commands table.
+
+        You only need this once, after the rollups were added, or if they
+        somehow went out of sync.
+        """
+        queries = (
+            'TRUNCATE command_usage, guild_command_usage, daily_command_usage;',
+
+            """INSERT INTO command_usage (command, uses)
+               SELECT command, COUNT(*) FROM commands GROUP BY command;
+            """,
+
+            """INSERT INTO guild_command_usage (guild_id, command, uses)
+               SELECT guild_id, command, COUNT(*) FROM commands
+               WHERE guild_id IS NOT NULL
+               GROUP BY guild_id, command;
+            """,
+
+            """INSERT INTO daily_command_usage (day, command, uses)
+               SELECT date_trunc('day', used), command, COUNT(*) FROM commands
+               GROUP BY date_trunc('day', used), command;
+            """,
+        )
+
+        # Holding the lock so that a flush can't happen halfway through this
+        # and get counted twice (or not at all).
+        async with ctx.typing(), self._command_flush_lock:
+            async with self.bot.db.get_session() as session:
+                conn = session.transaction.acquired_connection
+                for query in queries:
+                    await conn.execute(query)
+
+        await ctx.send('Done. The command rollups have been rebuilt.')
 
     @commands.command(name='stats')
     async def stats(self, ctx):
@@ -194,16 +352,33 @@ class Stats(Cog):
     async def history(self, ctx, n=5):
         """Shows the last n commands you've used."""
         n = min(n, 50)
+        before = ctx.message.created_at
+
+        # Some of the commands might not have been flushed yet.
+        # We don't want to show this command though.
+        pending = [
+            (prefix, command, used)
+            for _, _, author_id, used, prefix, command in reversed(self._pending_commands)
+            if author_id == ctx.author.id and used < before
+        ][:n]
+
+        # Using the time of the last command rather than an OFFSET, so this
+        # is just a seek on the (author_id, used) index.
+        if pending:
+            before = pending[-1][-1]
 
         query = (ctx.session.select.from_(Command)
-                            .where(Command.author_id == ctx.author.id)
+                            .where((Command.author_id == ctx.author.id) & (Command.used < before))
                             .order_by(Command.used, sort_order='desc')
-                            .offset(1)  # Skip this command.
-                            .limit(n)
+                            .limit(n - len(pending))
                  )
 
-        lines = [(f'`{row.prefix}{row.command}`', f'Executed {human_timedelta(row.used)}')
-                 async for row in await query.all()]
+        rows = pending
+        if len(pending) < n:
+            rows += [(row.prefix, row.command, row.used) async for row in await query.all()]
+
+        lines = [(f'`{prefix}{command}`', f'Executed {human_timedelta(used)}')
+                 for prefix, command, used in rows]
         title = pluralize(command=n)
         pages = EmbedFieldPages(ctx, lines, title=f"{ctx.author}'s last {title}",
                                 inline=False, lines_per_page=5)
@@ -1,14 +1,19 @@
+import asyncio
 import asyncpg
 import asyncqlio
+import bisect
+import collections
 import datetime
 import discord
+import heapq
 import itertools
 import logging
+import re
 
 from discord.ext import commands
 
 from .tables.base import TableBase
-from .utils import formats
+from .utils import cache, formats
 from .utils.paginator import ListPaginator
 
 from core.cog import Cog
@@ -35,6 +40,151 @@ class Tag(TableBase, table_name='tags'):
     created_at = asyncqlio.Column(asyncqlio.Timestamp)
 
 
+# Postgres only allows so many parameters in a query.
+_USES_CHUNK_SIZE = 1000
+
+async def _add_uses(conn, uses):
+    items = list(uses.items())
+    for i in range(0, len(items), _USES_CHUNK_SIZE):
+        chunk = items[i:i + _USES_CHUNK_SIZE]
+        values = ', '.join(f'(${j}::BIGINT, ${j + 1}::TEXT, ${j + 2}::INTEGER)'
+                           for j in range(1, len(chunk) * 3, 3))
+        query = f"""UPDATE tags SET uses = tags.uses + v.uses
+                    FROM (VALUES {values}) AS v (location_id, name, uses)
+                    WHERE tags.location_id = v.location_id AND tags.name = v.name;
+                 """
+        args = [arg for (guild_id, name), count in chunk for arg in (guild_id, name, count)]
+        await conn.execute(query, *args)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+class _TagRanking:
+    """A guild's tags, sorted from most to least used.
+
+    Ties go to the newer tag, and tags that are tied on both get the lowest
+    of their ranks, same as the old COUNT(*) query did.
+    """
+    __slots__ = ('_keys', '_by_name', 'total_uses')
+
+    def __init__(self, rows=()):
+        self._by_name = {name: self._make_key(name, uses, created_at) for name, uses, created_at in rows}
+        self._keys = sorted(self._by_name.values())
+        self.total_uses = sum(-key[0] for key in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _make_key(name, uses, created_at):
+        created = ((created_at or _EPOCH) - _EPOCH) // _MICROSECOND
+        return (-uses, -created, name)
+
+    def add(self, name, uses, created_at):
+        self.remove(name)
+        key = self._by_name[name] = self._make_key(name, uses, created_at)
+        bisect.insort(self._keys, key)
+        self.total_uses += uses
+
+    def remove(self, name):
+        key = self._by_name.pop(name, None)
+        if key is None:
+            return
+
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        self.total_uses += key[0]
+
+    def add_uses(self, name, count):
+        key = self._by_name.get(name)
+        if key is None:
+            return
+
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        key = self._by_name[name] = (key[0] - count, *key[1:])
+        bisect.insort(self._keys, key)
+        self.total_uses += count
+
+    def rank(self, name):
+        """Returns the 1-based rank of a tag, or None if it doesn't exist."""
+        key = self._by_name.get(name)
+        if key is None:
+            return None
+        # Anything with the same uses and creation time counts as well.
+        return bisect.bisect_left(self._keys, (key[0], key[1] + 1))
+
+    def top(self, n=None):
+        """Returns the (name, uses) of the n most used tags."""
+        return [(name, -uses) for uses, _, name in self._keys[:n]]
+
+
+# pg_trgm only cares about alphanumerics, anything else splits words.
+_trigram_words = re.compile(r'[^\W_]+').findall
+
+def _trigrams(string):
+    # Same as pg_trgm's show_trgm, every word is padded with two
+    # spaces in the front and one in the back.
+    grams = set()
+    for word in _trigram_words(string.lower()):
+        word = f'  {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return frozenset(grams)
+
+
+class _TrigramIndex:
+    """Fuzzy-matches a guild's tag names the same way pg_trgm's % and
+    similarity do, except it doesn't need pg_trgm or the DB at all.
+    """
+    # pg_trgm.similarity_threshold's default
+    THRESHOLD = 0.3
+
+    __slots__ = ('_grams', '_postings')
+
+    def __init__(self, names=()):
+        self._grams = {}
+        # trigram -> names that have it
+        self._postings = collections.defaultdict(set)
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._grams)
+
+    def add(self, name):
+        self.remove(name)
+        grams = self._grams[name] = _trigrams(name)
+        for gram in grams:
+            self._postings[gram].add(name)
+
+    def remove(self, name):
+        for gram in self._grams.pop(name, ()):
+            names = self._postings[gram]
+            names.discard(name)
+            if not names:
+                del self._postings[gram]
+
+    def search(self, query, limit=5):
+        """Returns up to limit names that are similar enough to the query,
+        most similar first.
+        """
+        grams = _trigrams(query)
+        if not grams:
+            return []
+
+        # Only names that share at least one trigram can possibly match.
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+
+        scored = []
+        for name, common in shared.items():
+            similarity = common / (len(grams) + len(self._grams[name]) - common)
+            if similarity >= self.THRESHOLD:
+                scored.append((similarity, name))
+
+        return [name for _, name in heapq.nlargest(limit, scored)]
+
+
 class MemberTagPaginator(ListPaginator):
     def __init__(self, *args, member, **kwargs):
         super().__init__(*args, **kwargs)
@@ -75,35 +225,159 @@ class TagName(commands.clean_content):
 
 class Tags(Cog):
     """You're it."""
+    # How many tags are kept per guild, and how many guilds they're kept for.
+    TAG_CACHE_SIZE = 256
+    TAG_CACHE_GUILDS = 1024
+    # Uses are written to the DB every this many seconds.
+    USES_FLUSH_INTERVAL = 5
+    # The rankings are kept up to date with the uses, but they're reloaded
+    # every now and then in case something else changed the table.
+    RANKING_TTL = 60 * 60
+
     def __init__(self, bot):
         self.bot = bot
+        # guild_id -> ExpiringCache of name -> content, with aliases already
+        # resolved to the original tag's content.
+        self._tag_cache = cache.ExpiringCache(self.TAG_CACHE_GUILDS)
+
+        # (guild_id, name) -> uses that haven't been written to the DB yet
+        self._pending_uses = collections.Counter()
+        self._uses_flush_lock = asyncio.Lock()
+        self._uses_flusher = bot.loop.create_task(self._flush_uses_periodically())
+
+    def __unload(self):
+        self._uses_flusher.cancel()
+        self.bot.loop.create_task(self.flush_uses())
+
+    async def on_shutdown(self):
+        self._uses_flusher.cancel()
+        await self.flush_uses()
+
+    async def _flush_uses_periodically(self):
+        while True:
+            await asyncio.sleep(self.USES_FLUSH_INTERVAL)
+            await self.flush_uses()
+
+    async def flush_uses(self):
+        """Writes all the pending tag uses to the DB in one UPDATE."""
+        async with self._uses_flush_lock:
+            uses, self._pending_uses = self._pending_uses, collections.Counter()
+            if not uses:
+                return
+
+            try:
+                async with self.bot.db.get_session() as session:
+                    await _add_uses(session.transaction.acquired_connection, uses)
+            except Exception:
+                tag_logger.exception('Failed to update the uses of %d tags', len(uses))
+                # Put them back so they can be tried again next time.
+                self._pending_uses.update(uses)
+                return
+
+            for (guild_id, name), count in uses.items():
+                ranking = self._get_ranking.cache.get(guild_id, count=False)
+                if ranking is not None:
+                    ranking.add_uses(name, count)
+
+    @cache.cache(maxsize=1024, ttl=RANKING_TTL, make_key=lambda a, kw: a[-1])
+    async def _get_ranking(self, guild_id):
+        # This is done under the flush lock so that the ranking doesn't
+        # miss (or double count) a flush that's happening at the same time.
+        async with self._uses_flush_lock, self.bot.db.get_session() as session:
+            query = """SELECT name, uses, created_at FROM tags
+                       WHERE location_id = {guild_id};
+                    """
+            rows = await (await session.cursor(query, {'guild_id': guild_id})).flatten()
+
+        return _TagRanking((r['name'], r['uses'], r['created_at']) for r in rows)
+
+    @cache.cache(maxsize=1024, ttl=RANKING_TTL, make_key=lambda a, kw: a[-1])
+    async def _get_tag_index(self, guild_id):
+        async with self.bot.db.get_session() as session:
+            query = session.select.from_(Tag).where(Tag.location_id == guild_id)
+            return _TrigramIndex([tag.name async for tag in await query.all()])
+
+    def _update_tag_index(self, guild_id, name=None, *, removed=False):
+        index = self._get_tag_index.cache.get(guild_id, count=False)
+        if index is None or name is None:
+            # Same deal as the ranking.
+            self._get_tag_index.invalidate(self, guild_id)
+        elif removed:
+            index.remove(name)
+        else:
+            index.add(name)
 
-    async def __error(self, ctx, error):
-        print('error!', error)
-        if isinstance(error, TagError):
-            await ctx.send(error)
+    async def _similar_tags(self, session, name, guild_id, limit=5):
+        index = self._get_tag_index.cache.get(guild_id, count=False)
+        if index is not None:
+            return index.search(name, limit)
 
-    async def _disambiguate_error(self, session, name, guild_id):
-        # ~~thanks danno~~
-        message = f'Tag "{name}" not found...'
+        # It's not worth making someone wait for all the guild's tags to be
+        # loaded, so we'll just ask the DB this time and have the index
+        # ready for next time.
+        self.bot.loop.create_task(self._get_tag_index(guild_id))
 
         query = """SELECT   name
                    FROM     tags
                    WHERE    location_id={guild_id} AND name % {name}
                    ORDER BY similarity(name, {name}) DESC
-                   LIMIT 5;
+                   LIMIT {limit};
                 """
-        params = {'guild_id': guild_id, 'name': name}
+        params = {'guild_id': guild_id, 'name': name, 'limit': limit}
         try:
             results = await (await session.cursor(query, params)).flatten()
         except asyncpg.SyntaxOrAccessError:
             # % and similarity aren't supported, which means the owner didn't do
-            # CREATE EXTENSION pg_trgm in their database
-            tag_logger.error('pg_trgm extension not created, contact %s to create it for the tags', self.bot.owner)
+            # CREATE EXTENSION pg_trgm in their database. Not a big deal, we
+            # just have to wait for the index.
+            tag_logger.warning('pg_trgm extension not created, falling back to the '
+                               'in-memory index for guild ID %d', guild_id)
+            index = await self._get_tag_index(guild_id)
+            return index.search(name, limit)
+
+        return [r['name'] for r in results]
+
+    def _update_ranking(self, guild_id, tag=None):
+        ranking = self._get_ranking.cache.get(guild_id, count=False)
+        if ranking is None:
+            # It might be getting loaded right now, in which case it might
+            # miss this change. It'll just be loaded again later.
+            self._get_ranking.invalidate(self, guild_id)
+        elif tag is None:
+            # Deleting a tag also deletes any number of aliases.
+            self._get_ranking.invalidate(self, guild_id)
+        else:
+            ranking.add(tag.name, tag.uses or 0, tag.created_at)
+
+    def _cached_tags(self, guild_id):
+        tags = self._tag_cache.get(guild_id)
+        if tags is None:
+            tags = self._tag_cache[guild_id] = cache.ExpiringCache(self.TAG_CACHE_SIZE)
+        return tags
+
+    def _invalidate_tags(self, guild_id, name=None):
+        if name is None:
+            # Aliases have the original's content cached, so when a tag
+            # changes it's easier to just start over for that guild.
+            self._tag_cache.pop(guild_id)
         else:
-            if results:
-                # f-strings can't have backslashes in {}
-                message += ' Did you mean...\n' + '\n'.join(r['name'] for r in results)
+            tags = self._tag_cache.get(guild_id, count=False)
+            if tags is not None:
+                tags.pop(name)
+
+    async def __error(self, ctx, error):
+        print('error!', error)
+        if isinstance(error, TagError):
+            await ctx.send(error)
+
+    async def _disambiguate_error(self, session, name, guild_id):
+        # ~~thanks danno~~
+        message = f'Tag "{name}" not found...'
+
+        results = await self._similar_tags(session, name, guild_id)
+        if results:
+            # f-strings can't have backslashes in {}
+            message += ' Did you mean...\n' + '\n'.join(results)
 
         return TagError(message)
 
@@ -127,13 +401,19 @@ class Tags(Cog):
     @commands.group(invoke_without_command=True)
     async def tag(self, ctx, *, name: TagName):
         """Retrieves a tag, if one exists."""
-        tag = await self._get_original_tag(ctx.session, name, ctx.guild.id)
-        await ctx.send(tag.content)
+        tags = self._cached_tags(ctx.guild.id)
+        content = tags.get(name)
+        if content is None:
+            tag = await self._get_original_tag(ctx.session, name, ctx.guild.id)
+            content = tags[name] = tag.content
+
+        await ctx.send(content)
+        self._pending_uses[ctx.guild.id, name] += 1
 
-        await (ctx.session.update.table(Tag)
-                          .where((Tag.name == name.lower()) & (Tag.location_id == ctx.guild.id))
-                          .set(Tag.uses + 1)
-               )
+    # Popular tags are usually cached, so the session is only acquired if
+    # the tag actually has to be looked up. This only applies to looking up
+    # a tag, the subcommands don't inherit it.
+    tag.needs_db = False
 
     @tag.command(name='create', aliases=['add'])
     async def tag_create(self, ctx, name: TagName, *, content):
@@ -152,6 +432,9 @@ class Tags(Cog):
         except asyncpg.UniqueViolationError as e:
             raise TagError(f'Tag {name} already exists...') from e
         else:
+            self._invalidate_tags(ctx.guild.id, name)
+            self._update_ranking(ctx.guild.id, tag)
+            self._update_tag_index(ctx.guild.id, name)
             await ctx.send(f'Successfully created tag {name}! ^.^')
 
     @tag.command(name='edit')
@@ -166,6 +449,7 @@ class Tags(Cog):
 
         tag.content = new_content
         await ctx.session.merge(tag)
+        self._invalidate_tags(ctx.guild.id)
         await ctx.send("Successfully edited the tag!")
 
     @tag.command(name='alias')
@@ -193,6 +477,9 @@ class Tags(Cog):
         except asyncpg.UniqueViolationError as e:
             raise TagError(f'Alias {alias} already exists...') from e
         else:
+            self._invalidate_tags(ctx.guild.id, alias.lower())
+            self._update_ranking(ctx.guild.id, new_tag)
+            self._update_tag_index(ctx.guild.id, new_tag.name)
             await ctx.send(f'Successfully created alias {alias} that points to {original}! ^.^')
 
     @tag.command(name='delete', aliases=['remove'])
@@ -213,6 +500,10 @@ class Tags(Cog):
             return await ctx.send("This tag is not yours.")
 
         await ctx.session.remove(tag)
+        self._invalidate_tags(ctx.guild.id)
+        self._update_ranking(ctx.guild.id)
+        # Deleting an actual tag deletes its aliases too, which we don't know about.
+        self._update_tag_index(ctx.guild.id, tag.name if tag.is_alias else None, removed=True)
         if not tag.is_alias:
             # Slow path, we gotta delete all aliases.
             await ctx.session.delete(Tag).where((Tag.location_id == ctx.guild.id)
@@ -223,25 +514,14 @@ class Tags(Cog):
         else:
             await ctx.send("Alias successfully deleted.")
 
-    async def _get_tag_rank(self, session, tag):
-        query = """SELECT COUNT(*) FROM tags
-                   WHERE location_id = {guild_id}
-                   AND (uses, created_at) >= ({uses}, {created})
-                """
-        # XXX: Not sure if asyncqlio covers tuple comparisons.
-        params = {'guild_id': tag.location_id, 'uses': tag.uses, 'created': tag.created_at}
-
-        result = await session.cursor(query, params)
-        return await result.fetch_row()
-
     @tag.command(name='info')
     async def tag_info(self, ctx, *, tag: TagName):
         """Shows the info of a tag or alias."""
-        # XXX: This takes roughly 8-16 ms. Not good, but to make my life
-        #      simpler I'll ignore it for now until the bot gets really big
-        #      and querying the tags starts becoming expensive.
         tag = await self._get_tag(ctx.session, tag, ctx.guild.id)
-        rank = await self._get_tag_rank(ctx.session, tag)
+        ranking = await self._get_ranking(ctx.guild.id)
+        rank = ranking.rank(tag.name)
+        # Some of the uses might not have been written yet.
+        uses = tag.uses + self._pending_uses.get((ctx.guild.id, tag.name), 0)
 
         user = ctx.bot.get_user(tag.owner_id)
         creator = user.mention if user else f'Unknown User (ID: {tag.owner_id})'
@@ -250,8 +530,8 @@ class Tags(Cog):
         embed = (discord.Embed(colour=ctx.bot.colour, timestamp=tag.created_at)
                  .set_author(name=tag.name, icon_url=icon_url)
                  .add_field(name='Created by', value=creator)
-                 .add_field(name='Used', value=f'{formats.pluralize(time=tag.uses)}', inline=False)
-                 .add_field(name='Rank', value=f'#{rank["count"]}', inline=False)
+                 .add_field(name='Used', value=f'{formats.pluralize(time=uses)}', inline=False)
+                 .add_field(name='Rank', value=f'#{rank}' if rank else 'Unranked', inline=False)
                  .set_footer(text='Created')
                  )
 
@@ -260,17 +540,37 @@ class Tags(Cog):
 
         await ctx.send(embed=embed)
 
+    @tag.command(name='top')
+    async def tag_top(self, ctx):
+        """Shows the most used tags in the server."""
+        ranking = await self._get_ranking(ctx.guild.id)
+        entries = (
+            [f'{name} ({formats.pluralize(use=uses)})' for name, uses in ranking.top()] or
+            (f'There are no tags. Use `{ctx.prefix}tag create` to fix that.', )
+        )
+
+        pages = ListPaginator(ctx, entries, title=f'Top tags in {ctx.guild}')
+        await pages.interact()
+
+    @tag.command(name='stats')
+    async def tag_stats(self, ctx):
+        """Shows some stats about the server's tags."""
+        ranking = await self._get_ranking(ctx.guild.id)
+        top = '\n'.join(f'{i}. {name} ({formats.pluralize(use=uses)})'
+                        for i, (name, uses) in enumerate(ranking.top(3), 1))
+
+        embed = (discord.Embed(colour=ctx.bot.colour)
+                 .set_author(name=f'Tag stats for {ctx.guild}')
+                 .add_field(name='Tags', value=str(len(ranking)))
+                 .add_field(name='Uses', value=str(ranking.total_uses))
+                 .add_field(name='Top Tags', value=top or 'None yet...', inline=False)
+                 )
+        await ctx.send(embed=embed)
+
     @tag.command(name='search')
     async def tag_search(self, ctx, *, name):
         """Searches and shows up to the 50 closest matches for a given name."""
-        query = """SELECT   name
-                   FROM     tags
-                   WHERE    location_id={guild_id} AND name % {name}
-                   ORDER BY similarity(name, {name}) DESC
-                   LIMIT 5;
-                """
-        params = {'guild_id': ctx.guild.id, 'name': name}
-        tags = [tag['name'] async for tag in await ctx.session.cursor(query, params)]
+        tags = await self._similar_tags(ctx.session, name, ctx.guild.id, limit=50)
         entries = itertools.starmap('{0}. {1}'.format, enumerate(tags, 1)) if tags else ['No results found... :(']
 
         pages = ListPaginator(ctx, entries, title=f'Tags relating to {name}')
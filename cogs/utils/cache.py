@@ -1,12 +1,13 @@
 import asyncio
+import collections
 import enum
 import functools
 import inspect
-
-from lru import LRU
+import time
 
 
 _keyword_marker = object()
+_missing = object()
 
 # Key-making functions
 def unordered(args, kwargs):
@@ -18,68 +19,193 @@ default_key = functools.partial(functools._make_key, typed=False)
 typed_key = functools.partial(functools._make_key, typed=True)
 
 
-# From Danny's cache.py, just with some modifications to allow for
+class _CacheEntry(collections.namedtuple('_CacheEntry', 'value expires weight')):
+    __slots__ = ()
+
+
+class ExpiringCache:
+    """An LRU cache where each entry can expire after some amount of time.
+
+    maxsize is the total weight the cache can hold before it starts evicting
+    the least recently used entries. By default every entry weighs 1, so it's
+    just the number of entries. If weigh is given, it's called on each value
+    to get its weight (e.g. sys.getsizeof to bound it by memory instead).
+
+    A maxsize of None means the cache is unbounded, and a ttl of None means
+    entries never expire.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, *, weigh=None, timefunc=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weight = 0
+        self._weigh = weigh
+        self._time = timefunc
+        self._data = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _missing, count=False) is not _missing
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, _missing) is _missing:
+            raise KeyError(key)
+
+    def get(self, key, default=None, *, count=True):
+        try:
+            entry = self._data[key]
+        except KeyError:
+            self.stats['misses'] += count
+            return default
+
+        if entry.expires is not None and entry.expires <= self._time():
+            self.pop(key)
+            self.stats['expirations'] += 1
+            self.stats['misses'] += count
+            return default
+
+        self._data.move_to_end(key)
+        self.stats['hits'] += count
+        return entry.value
+
+    def put(self, key, value, *, ttl=_missing):
+        if ttl is _missing:
+            ttl = self.ttl
+
+        self.pop(key)
+
+        expires = None if ttl is None else self._time() + ttl
+        weight = self._weigh(value) if self._weigh else 1
+        self._data[key] = _CacheEntry(value, expires, weight)
+        self.weight += weight
+
+        if self.maxsize is None:
+            return
+
+        while self.weight > self.maxsize and self._data:
+            _, entry = self._data.popitem(last=False)
+            self.weight -= entry.weight
+            self.stats['evictions'] += 1
+
+    def pop(self, key, default=None):
+        try:
+            entry = self._data.pop(key)
+        except KeyError:
+            return default
+
+        self.weight -= entry.weight
+        return entry.value
+
+    def clear(self):
+        self._data.clear()
+        self.weight = 0
+
+
+# Stats for every function decorated with cache, keyed by the function's name.
+registry = {}
+
+
+# Originally from Danny's cache.py, just with some modifications to allow for
 # custom key args, and the strategy is determined by the maxsize arg.
 # https://github.com/Rapptz/RoboDanny/blob/rewrite/cogs/utils/cache.py
-def cache(maxsize=128, make_key=default_key):
+#
+# It's since grown TTLs and the ability to coalesce concurrent misses, because
+# having 20 commands query the same thing at the same time is not fun.
+def cache(maxsize=128, make_key=default_key, *, ttl=None, negative_ttl=_missing, weigh=None):
+    """Caches the results of a function, or the awaited results of a coroutine.
+
+    Results of None are cached like any other value by default. If
+    negative_ttl is given, they are cached for that long instead.
+    (0 means they're not cached at all.)
+
+    Concurrent calls for a key that's currently being fetched will wait
+    on the same fetch rather than starting their own.
+    """
     def decorator(func):
-        if maxsize is None:
-            cache = {}
-            get_stats = lambda: (0, 0)
-        else:
-            cache = LRU(maxsize)
-            get_stats = cache.get_stats
-
-        def wrap_and_store(key, coro):
-            async def func():
-                value = await coro
-                cache[key] = value
-                return value
-            return func()
-
-        def wrap_new(value):
-            async def new_coroutine():
-                return value
-            return new_coroutine()
+        store = ExpiringCache(maxsize, ttl, weigh=weigh)
+        pending = {}
+        is_coroutine_function = asyncio.iscoroutinefunction(func)
+
+        def store_value(key, value):
+            if value is None and negative_ttl is not _missing:
+                if negative_ttl:
+                    store.put(key, value, ttl=negative_ttl)
+            else:
+                store.put(key, value)
+
+        def fetch_and_store(key, awaitable):
+            async def fetch():
+                try:
+                    value = await awaitable
+                    # Don't store it if the key was invalidated in the meantime,
+                    # the value is probably out of date.
+                    if pending.get(key) is task:
+                        store_value(key, value)
+                    return value
+                finally:
+                    if pending.get(key) is task:
+                        del pending[key]
+
+            task = pending[key] = asyncio.ensure_future(fetch())
+            return task
+
+        async def join(task):
+            # Shielded so that one caller getting cancelled doesn't
+            # cancel it for everyone else waiting on it.
+            return await asyncio.shield(task)
+
+        async def wrap_new(value):
+            return value
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             key = make_key(args, kwargs)
-            # try/except might be slow if the key is constantly not in the cache.
-            # I wonder if it's faster to use cache.get and compare to a sentinel.
-            try:
-                value = cache[key]
-            except KeyError:
-                value = func(*args, **kwargs)
-
-                if inspect.isawaitable(value):
-                    return wrap_and_store(key, value)
-
-                cache[key] = value
-                return value
-            else:
-                if asyncio.iscoroutinefunction(func):
-                    return wrap_new(value)
-                return value
+
+            value = store.get(key, _missing)
+            if value is not _missing:
+                return wrap_new(value) if is_coroutine_function else value
+
+            task = pending.get(key)
+            if task is not None:
+                store.stats['coalesced'] += 1
+                return join(task)
+
+            value = func(*args, **kwargs)
+            if inspect.isawaitable(value):
+                return join(fetch_and_store(key, value))
+
+            store_value(key, value)
+            return value
 
         def invalidate(*args, **kwargs):
-            # LRU.pop isn't a thing :(
-            # Implementation if LRU.pop existed would be much simpler:
-            #
-            # _sentinel = object()
-            # return cache.pop(make_key(args, kwargs), _sentinel) is not _sentinel
-            try:
-                del cache[make_key(args, kwargs)]
-            except KeyError:
-                return False
-            else:
-                return True
+            key = make_key(args, kwargs)
+            in_flight = pending.pop(key, None) is not None
+            return store.pop(key, _missing) is not _missing or in_flight
 
-        wrapper.cache = cache
+        def get_stats():
+            stats = store.stats
+            return stats['hits'], stats['misses']
+
+        wrapper.cache = store
+        wrapper.stats = store.stats
         wrapper.get_key = lambda *a, **kw: make_key(a, kw)
         wrapper.invalidate = invalidate
         wrapper.get_stats = get_stats
+
+        registry[f'{func.__module__}.{func.__qualname__}'] = store.stats
         return wrapper
     return decorator
 
-async_cache = cache
\ No newline at end of file
+async_cache = cache
@@ -0,0 +1,85 @@
+import collections
+
+
+class SnowflakeIndex:
+    """A warm, in-memory index of snowflakes, grouped into buckets.
+
+    This is meant for things that need to be checked on *every* command,
+    like plonks or blacklists, where hitting the DB each time would be
+    ridiculously wasteful. A bucket is usually a guild ID, but it can be
+    anything hashable (e.g. None for global stuff).
+
+    The index isn't ready until it's been loaded. Until then, lookups
+    should fall back to querying the DB, which is what ``ready`` is for.
+    """
+
+    def __init__(self):
+        self._buckets = collections.defaultdict(dict)
+        self.ready = False
+        # Changes made before the index is ready. The load's query might've
+        # missed them, so they're applied again on top of what was loaded.
+        self._pending = []
+        # hits = found an entry, misses = didn't find one,
+        # fallbacks = the index wasn't ready so the DB had to be used.
+        self.stats = collections.Counter()
+
+    def __contains__(self, bucket):
+        return bucket in self._buckets
+
+    def load(self, entries):
+        """Replaces the entire index with (bucket, snowflake, value) triples."""
+        buckets = collections.defaultdict(dict)
+        for bucket, snowflake, value in entries:
+            buckets[bucket][snowflake] = value
+
+        self._buckets = buckets
+        self.ready = True
+
+        pending, self._pending = self._pending, []
+        for method, args in pending:
+            method(*args)
+
+    def _record(self, method, *args):
+        if not self.ready:
+            self._pending.append((method, args))
+
+    def add(self, bucket, snowflake, value=None):
+        self._record(self.add, bucket, snowflake, value)
+        self._buckets[bucket][snowflake] = value
+
+    def discard(self, bucket, *snowflakes):
+        self._record(self.discard, bucket, *snowflakes)
+        entries = self._buckets.get(bucket)
+        if entries is None:
+            return
+
+        for snowflake in snowflakes:
+            entries.pop(snowflake, None)
+
+        if not entries:
+            del self._buckets[bucket]
+
+    def clear(self, bucket):
+        self._record(self.clear, bucket)
+        self._buckets.pop(bucket, None)
+
+    def find(self, bucket, *snowflakes):
+        """Returns the first (snowflake, value) pair in the bucket, or None.
+
+        The snowflakes are checked in order, so put the most important
+        one first.
+        """
+        # Using .get here rather than [] because we don't want the defaultdict
+        # to create empty buckets for every guild that gets looked up.
+        entries = self._buckets.get(bucket)
+        if entries:
+            for snowflake in snowflakes:
+                if snowflake in entries:
+                    self.stats['hits'] += 1
+                    return snowflake, entries[snowflake]
+
+        self.stats['misses'] += 1
+        return None
+
+    def snowflakes(self, bucket):
+        return self._buckets.get(bucket, {}).keys()
@@ -3,9 +3,12 @@ import contextlib
 import collections
 import itertools
 import json
+import logging
 import os
 import uuid
 
+log = logging.getLogger(__name__)
+
 
 JSONS_PATH = 'jsonfiles/'
 os.makedirs(JSONS_PATH, exist_ok=True)
@@ -17,15 +20,37 @@ class JSONFile(collections.MutableMapping):
 
     Basically a wrapper for persistent data, whenever I don't want to use a DB,
     usually because it will get queried a ton (which is always pleasant).
+
+    By default every change dumps the whole file right away. For files that
+    change a lot there are two options to make it cheaper:
+
+    flush_interval: Changes are only written out after this many seconds, so
+                    a burst of changes only results in one write. Anything
+                    that hasn't been written yet is written on close().
+    journal:        Changes are appended to a journal file instead of dumping
+                    the whole thing each time. The journal gets compacted into
+                    the actual file once it has compact_after entries.
     """
     _transform_key = str
 
     def __init__(self, name, **options):
         self._name = f'{JSONS_PATH}{name}'
+        self._journal_name = f'{self._name}.journal'
         self._db = {}
 
         self._loop = options.pop('loop', asyncio.get_event_loop())
         self._lock = asyncio.Lock()
+
+        self._flush_interval = options.pop('flush_interval', None)
+        self._flush_task = None
+        self._dirty = False
+
+        self._journal = options.pop('journal', False)
+        self._compact_after = options.pop('compact_after', 1000)
+        self._journal_size = 0
+        # Changes that haven't been written to the journal yet.
+        self._pending = []
+
         if options.pop('load_later', False):
             self._loop.create_task(self.load())
         else:
@@ -50,33 +75,124 @@ class JSONFile(collections.MutableMapping):
         with contextlib.suppress(FileNotFoundError), open(self._name, 'r') as f:
             self._db.update(json.load(f))
 
+        # Replay anything that was journaled since the last compaction.
+        # This is done even if journaling is off now, otherwise we'd lose stuff.
+        torn = False
+        with contextlib.suppress(FileNotFoundError), open(self._journal_name, 'r') as f:
+            for line in f:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('unterminated line')
+                    action, key, *value = json.loads(line)
+                except ValueError:
+                    # The bot probably died halfway through writing this line.
+                    torn = True
+                    break
+
+                if action == 'put':
+                    self._db[key] = value[0]
+                else:
+                    self._db.pop(key, None)
+                self._journal_size += 1
+
+        if torn:
+            # Anything appended after the broken line would never be replayed,
+            # so the journal has to be compacted before it's written to again.
+            log.warning('%s has a broken line, compacting it', self._journal_name)
+            self._dump(self._db.copy())
+            self._journal_size = 0
+
     async def load(self):
         async with self._lock:
             await self._loop.run_in_executor(None, self.load_from_file)
 
-    def _dump(self):
+    def _dump(self, data):
         temp = f'{self._name}-{uuid.uuid4()}.tmp'
         with open(temp, 'w', encoding='utf-8') as tmp:
-            json.dump(self._db.copy(), tmp, ensure_ascii=True, separators=(',', ':'))
+            json.dump(data, tmp, ensure_ascii=True, separators=(',', ':'))
 
         # atomically move the file
         os.replace(temp, self._name)
 
+        # Everything in the journal is in the file now.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._journal_name)
+
+    def _append(self, changes):
+        with open(self._journal_name, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(change, ensure_ascii=True, separators=(',', ':')) + '\n'
+                         for change in changes)
+
     async def save(self):
+        # Copying here rather than in _dump because that runs in another thread,
+        # and the dict might change while it's being dumped.
+        data = self._db.copy()
+        self._dirty = False
+        self._pending.clear()
+        async with self._lock:
+            await self._loop.run_in_executor(None, self._dump, data)
+        self._journal_size = 0
+
+    async def flush(self):
+        """Writes out any changes that haven't been written yet."""
+        if not self._dirty:
+            return
+
+        if not self._journal or self._journal_size + len(self._pending) >= self._compact_after:
+            await self.save()
+            return
+
+        changes, self._pending = self._pending, []
+        self._dirty = False
         async with self._lock:
-            await self._loop.run_in_executor(None, self._dump)
+            await self._loop.run_in_executor(None, self._append, changes)
+        self._journal_size += len(changes)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._flush_interval)
+        # This has to be cleared before flushing, so that close() doesn't
+        # cancel us while we're in the middle of writing.
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            log.exception('Flushing %s failed', self._name)
+            # Whatever was being journaled is gone now, so the next flush
+            # has to dump everything to be safe.
+            self._dirty = True
+            self._journal_size = self._compact_after
+
+    async def _changed(self, *changes):
+        self._dirty = True
+        if self._journal:
+            self._pending.extend(changes)
+
+        if self._flush_interval is None:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = self._loop.create_task(self._flush_later())
+
+    async def close(self):
+        """Writes out any pending changes right away."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
 
     async def put(self, key, value, *args):
         """Edits a config entry."""
-        self._db[self._transform_key(key)] = value
-        await self.save()
+        key = self._transform_key(key)
+        self._db[key] = value
+        await self._changed(('put', key, value))
 
     async def remove(self, key):
         """Removes a config entry."""
-        del self._db[self._transform_key(key)]
-        await self.save()
-
-    async def update(self, mapping, **kwargs):
-        super().update(mapping, **kwargs)
-        await self.save()
+        key = self._transform_key(key)
+        del self._db[key]
+        await self._changed(('remove', key))
+
+    async def update(self, mapping=(), **kwargs):
+        items = dict(mapping, **kwargs)
+        super().update(items)
+        await self._changed(*(('put', self._transform_key(k), v) for k, v in items.items()))
 
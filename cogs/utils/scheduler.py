@@ -2,9 +2,13 @@ import asyncio
 import collections
 import datetime
 import heapq
+import itertools
 import json
 import logging
+import math
+import os
 import time
+import uuid
 
 log = logging.getLogger(__name__)
 
@@ -51,11 +55,123 @@ class _Entry(collections.namedtuple('_Entry', 'time event args kwargs created id
         """Returns True if the event is "short".
 
         A short event gives an optimization opportunity, it doesn't have to be
-        sorted, in the queue or database. Instead, a Task can be created where
-        it sleeps for a period of time before being dispatched.
+        sorted, in the queue or database. Instead, it can just go on a
+        TimerWheel until it's dispatched.
         """
         return self.seconds <= 30
 
+class TimerWheel:
+    """A hashed timing wheel, for when there are a lot of short timers.
+
+    Rather than having one Task sleeping per timer, timers are hashed into
+    one of a fixed number of slots by the tick they expire on, and a single
+    Task goes around the wheel once per tick, expiring whatever's due.
+    Adding and cancelling a timer are both O(1).
+
+    The catch is that timers are only as precise as the resolution, which
+    is why this is only used for short entries.
+    """
+
+    def __init__(self, callback, *, resolution=0.1, slots=512, loop=None, timefunc=time.monotonic):
+        self.callback = callback
+        self.resolution = resolution
+        self._loop = loop or asyncio.get_event_loop()
+        self._time = timefunc
+        self._start = timefunc()
+        self._slots = [{} for _ in range(slots)]
+        # key -> slot that the timer is in, for O(1) cancellation.
+        self._index = {}
+        self._keys = itertools.count()
+        # The last tick that was processed.
+        self._tick = 0
+        self._driver = None
+        # Bumped whenever the driver is cancelled, so that a cancelled driver
+        # can tell that it's been replaced by the time it actually exits.
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def _current_tick(self):
+        return int((self._time() - self._start) / self.resolution)
+
+    def add(self, delay, item, key=None):
+        """Calls the callback with item after delay seconds.
+
+        Returns a key that can be used to cancel it.
+        """
+        if key is None:
+            key = next(self._keys)
+
+        self.cancel(key)
+
+        if self._driver is None:
+            # The wheel hasn't been turning, so we have to catch up.
+            self._tick = self._current_tick()
+
+        target = max(self._tick + 1, math.ceil((self._time() + delay - self._start) / self.resolution))
+        slot = self._slots[target % len(self._slots)]
+        slot[key] = target, item
+        self._index[key] = slot
+
+        if self._driver is None:
+            self._driver = self._loop.create_task(self._drive(self._generation))
+        return key
+
+    def cancel(self, key):
+        """Cancels a timer. Returns True if there was a timer to cancel."""
+        slot = self._index.pop(key, None)
+        if slot is None:
+            return False
+
+        del slot[key]
+        return True
+
+    def clear(self):
+        for slot in self._slots:
+            slot.clear()
+        self._index.clear()
+
+        if self._driver is not None:
+            self._driver.cancel()
+            self._driver = None
+            self._generation += 1
+
+    def _expire(self, tick):
+        slot = self._slots[tick % len(self._slots)]
+        due = [(key, item) for key, (target, item) in slot.items() if target <= tick]
+
+        for key, item in due:
+            del slot[key]
+            del self._index[key]
+            try:
+                self.callback(item)
+            except Exception:
+                log.exception('Callback for timer %r failed', item)
+
+    async def _drive(self, generation):
+        try:
+            while self._index:
+                # Sleeping until the absolute time of the next tick, rather than
+                # sleeping for the resolution, so that we don't drift.
+                next_tick = self._start + (self._tick + 1) * self.resolution
+                await asyncio.sleep(max(0, next_tick - self._time()))
+
+                # If the loop was blocked we might've missed a few ticks.
+                now = self._current_tick()
+                while self._tick < now:
+                    self._tick += 1
+                    self._expire(self._tick)
+        finally:
+            # A timer could've been added between clear() and this, which
+            # would've started a new driver that we mustn't forget about.
+            if generation == self._generation:
+                self._driver = None
+
+
 class BaseScheduler:
     """Manages timing related things.
 
@@ -80,13 +196,20 @@ class BaseScheduler:
         self._current = None
         self._runner = None
         self._callbacks = []
+        # Set whenever the head of the schedule might've changed, so the
+        # runner can re-check it without having to be cancelled.
+        self._wakeup = asyncio.Event()
+        self._short_timers = TimerWheel(self._dispatch, loop=self._loop)
 
     def __del__(self):
         self.close()
 
     @staticmethod
     def _calculate_delta(time1, time2):
-        return time1 - time2
+        delta = time1 - time2
+        if isinstance(delta, datetime.timedelta):
+            delta = delta.total_seconds()
+        return delta
 
     # These four methods must be implemented in subclasses
 
@@ -102,30 +225,65 @@ class BaseScheduler:
     async def _cleanup(self):
         pass
 
+    async def _find(self, event, args, limit, offset):
+        raise NotImplementedError
+
+    # These two are optional, for schedulers that can dispatch (and clean up)
+    # a bunch of entries at once rather than going one at a time.
+
+    async def _get_due(self, now):
+        return [self._current]
+
+    async def _done(self, entries):
+        pass
+
     async def _update(self):
         while True:
+            # This has to be cleared *before* getting the head, otherwise
+            # a wakeup that happens while we're getting it would be lost.
+            self._wakeup.clear()
             self._current = timer = await self._get()
             now = self.time_function()
             delta = self._calculate_delta(timer.time, now)
-            log.debug('sleeping for %s seconds', delta)
 
-            while delta > 0:
-                await asyncio.sleep(min(self.MAX_SLEEP_TIME, delta))
-                delta -= self.MAX_SLEEP_TIME
+            if delta > 0:
+                log.debug('sleeping for %s seconds', delta)
+                handle = self._loop.call_later(min(self.MAX_SLEEP_TIME, delta), self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    handle.cancel()
+
+                # Either the entry is due, or the head changed while we were
+                # sleeping. Either way we have to check the head again.
+                continue
+
+            # The sleep might've woken up a hair early, so make sure that
+            # the entry we were waiting on is always counted as due.
+            now = max(now, timer.time)
+
+            # Shielded because the runner can get cancelled by stop(), and we
+            # don't want entries to be dispatched twice, or taken off the
+            # schedule and then never dispatched.
+            await asyncio.shield(self._dispatch_due(now))
+
+    async def _dispatch_due(self, now):
+        entries = await self._get_due(now)
+        log.debug('%d entries are done, dispatching now.', len(entries))
+
+        for entry in entries:
+            self._dispatch(entry)
+        self._current = None
+
+        await self._done(entries)
 
-            log.debug('entry %r is done, dispatching now.', timer)
-            self._dispatch(self._current)
+    def _wake(self):
+        self._wakeup.set()
 
     def _restart(self):
         self.stop()
         self.run()
 
-    async def _short_task_optimization(self, delta, event):
-        # XXX: Is it a good idea to use self._loop.call_later? It's short enough,
-        #      and self._dispatch is not a coroutine.
-        await asyncio.sleep(delta)
-        self._dispatch(event)
-
     async def add_abs(self, when, action, args=(), kwargs=None, id=None):
         """Enter a new event in the queue at an absolute time.
 
@@ -136,14 +294,17 @@ class BaseScheduler:
         kwargs = kwargs or {}
         event = _Entry(when, action, args, kwargs, None)
         if event.short:
-            # Allow for short timer optimization
-            self._loop.create_task(self._short_task_optimization(event.seconds, event))
+            # Short entries don't need to be stored anywhere, they can just go
+            # on the timer wheel.
+            self._short_timers.add(event.seconds, event)
             return
 
-        await self._put(event)
+        event = await self._put(event)
 
-        if self._current and event.time <= self._current.time:
-            self._restart()
+        # Only bother the runner if the new entry is now the head.
+        if self._current is not None and event.time < self._current.time:
+            self._wake()
+        return event
 
     async def add(self, delay, action, args=(), kwargs=None, id=None):
         """A variant that specifies the time as a relative time.
@@ -158,7 +319,21 @@ class BaseScheduler:
         """Removes an entry from the queue."""
         await self._remove(entry)
 
-        self._restart()
+        if self._current is not None and self._current.id == entry.id:
+            self._wake()
+
+    async def get_entries(self, event, *args, limit=None, offset=0):
+        """Returns the pending entries for an event, soonest first.
+
+        If args are given, only the entries whose args start with
+        those are returned. Short entries are never returned.
+        """
+        if offset < 0:
+            raise ValueError(f'offset must be non-negative, not {offset}')
+        if limit is not None and limit <= 0:
+            raise ValueError(f'limit must be positive, not {limit}')
+
+        return await self._find(event, args, limit, offset)
 
     # Callback-related things
     def _dispatch(self, timer):
@@ -207,48 +382,189 @@ class BaseScheduler:
             self._runner.cancel()
 
     def close(self):
-        """Closes the running task, and does any cleanup, if necessary."""
+        """Closes the running task, and does any cleanup, if necessary.
+
+        Returns the Task doing the cleanup, in case you need to wait for it.
+        """
         self.stop()
-        self.loop.create_task(self._cleanup())
+        self._short_timers.clear()
         del self._callbacks[:]
         self._current = None
+        return self._loop.create_task(self._cleanup())
+
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _dump_time(t):
+    return t.strftime(_TIME_FORMAT) if isinstance(t, datetime.datetime) else t
+
+def _load_time(t):
+    return datetime.datetime.strptime(t, _TIME_FORMAT) if isinstance(t, str) else t
 
 
 class QueueScheduler(BaseScheduler):
-    """Original implementation of a scheduler.
+    """An in-memory implementation of a scheduler.
 
-    This uses an asyncio.PriorityQueue, which means all of the events are stored
-    in memory. This can be very risky if too many entries are stored.
+    All the entries are kept in a heap, so there's no round-trip for every
+    single entry. Removed entries are left in the heap and skipped when they
+    come up, and the heap gets rebuilt if there are too many of them.
+
+    Because everything's in memory, everything is lost when the bot goes down.
+    If snapshot_path is given, the entries are saved there every so often (and
+    when the scheduler's closed), and loaded back when it's created. This only
+    makes sense if timefunc is a wall-clock (e.g. datetime.utcnow).
     """
 
-    def __init__(self, **kwargs):
-        super().__init(**kwargs)
-        self._pending = asyncio.PriorityQueue()
+    def __init__(self, *, snapshot_path=None, snapshot_interval=60, **kwargs):
+        super().__init__(**kwargs)
+        # (time, id, entry) triples.
+        self._heap = []
+        # id -> entry of every entry that hasn't been removed or dispatched.
+        self._entries = {}
+        self._by_event = collections.defaultdict(dict)
+        self._tombstones = 0
+        self._ids = itertools.count(1)
+        self._have_data = asyncio.Event()
 
-    # We have to override _restart as well because _get removes the entry.
-    def _restart(self):
-        if self._current is not None:
-            self._pending.put_nowait(self._current)
-        super()._restart()
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_task = None
+        self._dirty = False
+        if snapshot_path:
+            self._load_snapshot()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _track(self, entry):
+        heapq.heappush(self._heap, (entry.time, entry.id, entry))
+        self._entries[entry.id] = entry
+        self._by_event[entry.event][entry.id] = entry
+        self._dirty = True
+
+    def _untrack(self, id):
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            return None
+
+        events = self._by_event[entry.event]
+        del events[id]
+        if not events:
+            del self._by_event[entry.event]
+
+        self._dirty = True
+        return entry
 
     async def _get(self):
-        return await self._pending.get()
+        heap = self._heap
+        while True:
+            while heap and heap[0][1] not in self._entries:
+                heapq.heappop(heap)
+                self._tombstones -= 1
+
+            if heap:
+                return heap[0][-1]
+
+            self._have_data.clear()
+            await self._have_data.wait()
+
+    async def _get_due(self, now):
+        heap = self._heap
+        entries = []
+        while heap and heap[0][0] <= now:
+            _, id, _ = heapq.heappop(heap)
+            entry = self._untrack(id)
+            if entry is None:
+                self._tombstones -= 1
+            else:
+                entries.append(entry)
+        return entries
 
     async def _put(self, entry):
-        self._pending.put_nowait(entry)
+        entry = entry._replace(id=next(self._ids))
+        self._track(entry)
+        self._have_data.set()
+        return entry
 
     async def _remove(self, entry):
-        # Don't remove the entry if it's the current one because _get will
-        # remove the entry from the queue.
-        if entry == self._current:
-            self._current = None  # Needed to tell _restart to not put the entry back in.
-        else:
-            self.pending._queue.remove(entry)
-            heapq.heapify(self.pending._queue)
+        if self._untrack(entry.id) is None:
+            return
+
+        self._tombstones += 1
+        # Rebuild the heap if it's mostly dead entries.
+        if self._tombstones > 1024 and self._tombstones > len(self._entries):
+            self._heap = [(e.time, e.id, e) for e in self._entries.values()]
+            heapq.heapify(self._heap)
+            self._tombstones = 0
+
+    async def _find(self, event, args, limit, offset):
+        n = len(args)
+        entries = sorted(
+            (e for e in self._by_event.get(event, {}).values() if tuple(e.args[:n]) == args),
+            key=lambda e: (e.time, e.id)
+        )
+        stop = None if limit is None else offset + limit
+        return entries[offset:stop]
+
+    # Snapshot stuff
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+
+        for id, time, event, args, kwargs, created in data['entries']:
+            self._track(_Entry(_load_time(time), event, args, kwargs, _load_time(created), id))
+
+        self._ids = itertools.count(max(self._entries, default=0) + 1)
+        self._dirty = False
+
+    def _dump_snapshot(self, entries):
+        temp = f'{self.snapshot_path}-{uuid.uuid4()}.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f, ensure_ascii=True, separators=(',', ':'))
+
+        # atomically move the file
+        os.replace(temp, self.snapshot_path)
+
+    async def save_snapshot(self):
+        """Saves all the entries to the snapshot file, if anything changed."""
+        if not (self.snapshot_path and self._dirty):
+            return
+
+        entries = [
+            (e.id, _dump_time(e.time), e.event, e.args, e.kwargs, _dump_time(e.created))
+            for e in self._entries.values()
+        ]
+        self._dirty = False
+        await self._loop.run_in_executor(None, self._dump_snapshot, entries)
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.save_snapshot()
+            except Exception:
+                log.exception('Saving the scheduler snapshot failed')
+                self._dirty = True
+
+    async def _cleanup(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        await self.save_snapshot()
+
+    def run(self):
+        if self.snapshot_path and self._snapshot_task is None:
+            self._snapshot_task = self._loop.create_task(self._snapshot_loop())
+        super().run()
 
 
 # Below here is the database form of the scheduler. If you want to just use the
 # scheduler without worrying about using a DB, then ignore everything below here.
+import asyncpg
 import asyncqlio
 import json
 
@@ -271,77 +587,295 @@ class DatabaseScheduler(BaseScheduler):
     """An implementation of a Scheduler where a database is used.
 
     Only DBMSs that support JSON types are supported (so basically just PostgresSQL).
+
+    Rather than going to the database for every single entry, this grabs the
+    next BATCH_SIZE entries at once and keeps them in a heap. Everything that's
+    due gets deleted in one go before it's dispatched, and only the entries
+    that were actually deleted get dispatched. This way if there are several
+    schedulers on the same database, each entry is only dispatched by one.
+
+    If listen_dsn is given, the scheduler also LISTENs for changes made by
+    other processes sharing the same database, so it picks up entries that
+    were added elsewhere, and drops ones that were removed (or dispatched)
+    elsewhere without having to go to the database.
     """
+    BATCH_SIZE = 500
+    NOTIFY_CHANNEL = 'schedule_changes'
 
-    def __init__(self, db, *, safe_mode=True, **kwargs):
+    def __init__(self, db, *, safe_mode=True, batch_size=None, listen_dsn=None, **kwargs):
         super().__init__(**kwargs)
         self._db = db
         self._md = self._db.bind_tables(_Table)
         self._safe = safe_mode
         self._have_data = asyncio.Event()
-        self._db_lock = asyncio.Event()
-        self.add_callback(self._sync_remove)
-
-    def _sync_remove(self, entry):
-        # Because we're scheduling a task rather than running the coroutine
-        # right away, there might be a slight race in that _update
-        # might grab the already done entry and dispatch it again.
-        # We need to make sure that doesn't happen. Which is why this
-        # asyncio.Event is here to keep it synchronized.
-        if getattr(entry, 'short', False):
-            # The entry was short, so there's no entry to remove in the database.
-            return 
-        self._db_lock.clear()
-        self._loop.create_task(self._remove(entry))
+        self.batch_size = batch_size or self.BATCH_SIZE
+
+        # (time, id, entry) triples of everything that's been fetched.
+        self._heap = []
+        # IDs of the entries in the heap that are still live. Removed entries
+        # are just dropped from here and skipped when they get popped.
+        self._ids = set()
+        # The latest expiry time of the entries in the heap. Anything after
+        # this is only in the database. None means nothing's been fetched yet.
+        self._horizon = None
+        # Whether the last fetch got everything that was in the database.
+        # If so, the heap is the whole schedule.
+        self._fetched_all = False
+
+        self._listen_dsn = listen_dsn
+        self._listener = None
+        # Used to ignore our own notifications.
+        self._token = uuid.uuid4().hex
 
     # Overriding this because the two are datetime instances.
     @staticmethod
     def _calculate_delta(time1, time2):
         return (time1 - time2).total_seconds()
 
-    async def _get_entry(self):
-        await self._db_lock.wait()
+    def _push(self, entry):
+        if entry.id in self._ids:
+            return
+
+        heapq.heappush(self._heap, (entry.time, entry.id, entry))
+        self._ids.add(entry.id)
+
+    def _in_window(self, entry):
+        return self._fetched_all or (self._horizon is not None and entry.time <= self._horizon)
+
+    def _trim(self):
+        # Once everything's been fetched, every new entry goes in the heap,
+        # so it'd grow to the whole schedule if we let it. It's only trimmed
+        # once it's twice the batch size so that this isn't done on every put.
+        if len(self._ids) <= self.batch_size * 2:
+            return
+
+        live = sorted(item for item in self._heap if item[1] in self._ids)
+        cutoff = live[self.batch_size][0]
+        # Anything expiring at the same time as the cutoff has to go too,
+        # otherwise the window would claim to have entries that it doesn't.
+        kept = [item for item in live[:self.batch_size] if item[0] < cutoff]
+        if not kept:
+            return
+
+        # A sorted list is already a valid heap.
+        self._heap = kept
+        self._ids = {id for _, id, _ in kept}
+        self._horizon = kept[-1][0]
+        self._fetched_all = False
+        log.debug('trimmed the heap down to %d entries', len(kept))
+
+    def _peek(self):
+        heap, ids = self._heap, self._ids
+        while heap and heap[0][1] not in ids:
+            heapq.heappop(heap)
+        return heap[0][-1] if heap else None
+
+    async def _fetch(self):
+        async with self._lock, self._db.get_session() as session:
+            query = session.select(_Schedule).order_by(_Schedule.expires).limit(self.batch_size)
+            records = [record async for record in await query.all()]
+
+            for record in records:
+                self._push(_Entry.from_record(record))
+
+            self._fetched_all = len(records) < self.batch_size
+            if records:
+                self._horizon = records[-1].expires
+            self._trim()
+
+        log.debug('fetched %d entries from the database', len(records))
+
+    # LISTEN/NOTIFY stuff, this is only used if listen_dsn was given.
+
+    async def _notify(self, session, action, id):
+        if self._listen_dsn is None:
+            return
+
+        query = 'SELECT pg_notify({channel}, {payload});'
+        params = {'channel': self.NOTIFY_CHANNEL, 'payload': f'{self._token} {action} {id}'}
+        await session.execute(query, params)
+
+    async def _listen(self):
+        self._listener = await asyncpg.connect(self._listen_dsn)
+        await self._listener.add_listener(self.NOTIFY_CHANNEL, self._on_notification)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        token, action, ids = payload.split()
+        if token == self._token:
+            return
+
+        if action == 'remove':
+            ids = set(map(int, ids.split(',')))
+            self._ids -= ids
+            if self._current is not None and self._current.id in ids:
+                self._wake()
+        else:
+            self._loop.create_task(self._fetch_one(int(ids)))
+
+    async def _fetch_one(self, id):
         async with self._db.get_session() as session:
-            query = session.select(_Schedule).order_by(_Schedule.expires).limit(1)
-            return await query.first()
+            record = await session.select(_Schedule).where(_Schedule.id == id).first()
+
+        if record is None:
+            return
+
+        entry = _Entry.from_record(record)
+        if not self._in_window(entry):
+            # The next fetch will pick it up.
+            return
+
+        self._push(entry)
+        self._trim()
+        self._have_data.set()
+        if self._current is not None and entry.time < self._current.time:
+            self._wake()
 
     async def _get(self):
         while True:
-            entry = await self._get_entry()  # Get the entry from the database
+            entry = self._peek()
             if entry is not None:
-                return _Entry.from_record(entry)
+                return entry
+
+            if not self._fetched_all:
+                await self._fetch()
+                if self._heap:
+                    continue
 
             self._have_data.clear()
             await self._have_data.wait()
 
+    async def _get_due(self, now):
+        heap, ids = self._heap, self._ids
+        entries = []
+        while heap and heap[0][0] <= now:
+            _, id, entry = heapq.heappop(heap)
+            if id in ids:
+                ids.remove(id)
+                entries.append(entry)
+
+        if not entries:
+            return entries
+
+        # Another scheduler might've already dispatched some of these.
+        claimed = await self._claim([entry.id for entry in entries])
+        return [entry for entry in entries if entry.id in claimed]
+
+    async def _claim(self, ids):
+        # Deleting the entries is what claims them, so whoever gets them
+        # back from the DELETE is the one that gets to dispatch them.
+        query = 'DELETE FROM schedule WHERE id = ANY({ids}) RETURNING id;'
+        try:
+            async with self._db.get_session() as session:
+                records = await (await session.cursor(query, {'ids': ids})).flatten()
+        except Exception as e:
+            # Something went terribly wrong with removing, so we gotta stop
+            # the scheduler, otherwise we'd run into an infinite loop.
+            if self._safe:
+                self.stop()
+            log.error('Removing %d entries failed. Exception: %r', len(ids), e)
+            raise
+
+        return {record['id'] for record in records}
+
+    async def _done(self, entries):
+        # Let the other schedulers know these are gone, so they can drop them
+        # rather than trying to claim them when they come up.
+        if self._listen_dsn is None or not entries:
+            return
+
+        ids = [str(entry.id) for entry in entries]
+        # NOTIFY payloads have to be under 8000 bytes.
+        chunk_size = 400
+        try:
+            async with self._db.get_session() as session:
+                for i in range(0, len(ids), chunk_size):
+                    await self._notify(session, 'remove', ','.join(ids[i:i + chunk_size]))
+        except Exception as e:
+            # Not the end of the world, they'll find out when they try to
+            # claim them.
+            log.warning('Notifying removal of %d entries failed. Exception: %r', len(ids), e)
+
     async def _put(self, entry):
         # put the entry in the database
         # We have to use a manual query because of the JSON type.
         query = """INSERT INTO schedule (created, event, args_kwargs, expires)
                    VALUES ({t}, {ev}, {ex}::jsonb, {exp})
+                   RETURNING id;
                 """
         params = {'t': entry.created, 'ev': entry.event, 'exp': entry.time,
                   'ex': json.dumps({'args': entry.args, 'kwargs': entry.kwargs})}
 
-        async with self._db.get_session() as session:
-            await session.execute(query, params)
+        # The lock is so a fetch that's happening at the same time can't miss
+        # this entry (and then think it got everything).
+        async with self._lock:
+            async with self._db.get_session() as session:
+                row = await (await session.cursor(query, params)).fetch_row()
+                await self._notify(session, 'put', row['id'])
+
+            entry = entry._replace(id=row['id'])
+            if self._in_window(entry):
+                self._push(entry)
+                self._trim()
+
         self._have_data.set()
+        return entry
+
+    async def _find(self, event, args, limit, offset):
+        # We have to go to the lowest level possible, because simply using
+        # session.cursor WILL NOT work, as it uses str.format to format
+        # the parameters, which will throw a KeyError due to the {} in the
+        # JSON operators.
+        conditions = ''.join(
+            f"AND args_kwargs #>> '{{args,{i}}}' = ${i + 2}\n"
+            for i in range(len(args))
+        )
+        query = f"""SELECT *
+                    FROM schedule
+                    WHERE event = $1
+                    {conditions}
+                    ORDER BY expires
+                    OFFSET {int(offset)}
+                 """
+        if limit is not None:
+            query += f'LIMIT {int(limit)}'
+
+        async with self._db.get_session() as session:
+            connection = session.transaction.acquired_connection
+            records = await connection.fetch(query, event, *map(str, args))
+
+        entries = []
+        for record in records:
+            args_kwargs = json.loads(record['args_kwargs'])
+            entries.append(_Entry(
+                time=record['expires'],
+                event=record['event'],
+                args=args_kwargs['args'],
+                kwargs=args_kwargs['kwargs'],
+                created=record['created'],
+                id=record['id'],
+            ))
+        return entries
 
     async def _remove(self, entry):
         # remove entry from the database
         try:
             async with self._db.get_session() as session:
                 await session.delete.table(_Schedule).where(_Schedule.id == entry.id)
+                await self._notify(session, 'remove', entry.id)
         except Exception as e:
-            # Something went terribly wrong with removing, so we gotta stop
-            # the scheduler, otherwise we'd run into an infinite loop.
             if self._safe:
                 self.stop()
             log.error('Removing %r failed. Exception: %r', entry, e)
             raise
         else:
-            self._db_lock.set()
+            self._ids.discard(entry.id)
+
+    async def _cleanup(self):
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
 
     def run(self):
-        self._db_lock.set()  # Set the event right away so we don't just wait.
+        if self._listen_dsn is not None and self._listener is None:
+            self._loop.create_task(self._listen())
         super().run()
@@ -57,6 +57,23 @@ extensions = []
 # to double them up. For e.g. {{status}}
 games = []
 
+# ---------------------- SCHEDULER --------------------
+
+# Where the bot should store things like reminders, mutes and tempbans.
+# This can be one of two things:
+# 1. 'database' - Stored in the PostgreSQL database. This is the default.
+# 2. 'memory' - Stored in memory, and saved to jsonfiles/schedule.json every so
+#    often. This is faster, but only use it if you're running one instance of
+#    the bot, and don't mind losing the last minute of changes if it crashes.
+scheduler = 'database'
+
+# Whether the scheduler should listen for changes other processes make to the
+# schedule, using PostgreSQL's LISTEN/NOTIFY. You only need this if you're running
+# more than one instance of the bot on the same database. (Each entry is only ever
+# dispatched by one instance either way, but without this an instance might not notice
+# entries added by another one.)
+scheduler_notify = False
+
 # ----------------------- COLOURS ---------------------
 
 # The default colour the bot will use for embeds
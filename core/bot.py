@@ -9,6 +9,7 @@ import functools
 import inspect
 import json
 import logging
+import logging.handlers
 import random
 import re
 import sys
@@ -16,6 +17,7 @@ import traceback
 
 from datetime import datetime
 from discord.ext import commands
+from discord.ext.commands.view import StringView
 from more_itertools import always_iterable
 
 from . import context
@@ -24,9 +26,9 @@ from .formatter import ChiakiFormatter
 
 from cogs.tables.base import TableBase
 from cogs.utils import errors
-from cogs.utils.jsonf import JSONFile
+from cogs.utils.jsonf import JSONFile, JSONS_PATH
 from cogs.utils.misc import file_handler
-from cogs.utils.scheduler import DatabaseScheduler
+from cogs.utils.scheduler import DatabaseScheduler, QueueScheduler
 from cogs.utils.time import duration_units
 
 # The bot's config file
@@ -36,7 +38,11 @@ log = logging.getLogger(__name__)
 log.addHandler(file_handler('chiakinanami'))
 
 command_log = logging.getLogger('commands')
-command_log.addHandler(file_handler('commands'))
+# Buffered because this gets written to on every single command. It's also
+# flushed every so often, so a quiet bot doesn't sit on its logs forever.
+_command_log_handler = logging.handlers.MemoryHandler(256, target=file_handler('commands'))
+command_log.addHandler(_command_log_handler)
+COMMAND_LOG_FLUSH_INTERVAL = 30
 
 
 def _is_submodule(parent, child):
@@ -89,6 +95,32 @@ del _make_permissions
 
 MAX_FORMATTER_WIDTH = 90
 
+def _needs_db(command):
+    # Commands can set this themselves, e.g. command.needs_db = False,
+    # otherwise it's up to the cog. Note that subcommands don't inherit
+    # this from their group.
+    try:
+        return command.needs_db
+    except AttributeError:
+        return getattr(command.instance, '__needs_db__', True)
+
+def _invoked_command(ctx):
+    # ctx.command is only the root command. Which subcommand is going to
+    # be invoked isn't known until the group is invoked, so we have to
+    # peek ahead, the same way Group.invoke finds it.
+    command, view = ctx.command, ctx.view
+    index, previous = view.index, view.previous
+    try:
+        while isinstance(command, commands.GroupMixin):
+            view.skip_ws()
+            subcommand = command.all_commands.get(view.get_word())
+            if subcommand is None:
+                break
+            command = subcommand
+    finally:
+        view.index, view.previous = index, previous
+    return command
+
 def _callable_prefix(bot, message):
     if message.guild:
         prefixes = bot.custom_prefixes.get(message.guild.id, bot.default_prefix)
@@ -98,6 +130,26 @@ def _callable_prefix(bot, message):
     return commands.when_mentioned_or(*prefixes)(bot, message)
 
 
+def _compile_prefixes(user_id, prefixes):
+    # The mentions have to go first, to match the order that
+    # commands.when_mentioned_or uses. Alternations are tried from left
+    # to right, so this ends up matching the same prefix a linear
+    # startswith scan would.
+    return re.compile('|'.join([f'<@!?{user_id}> ', *map(re.escape, prefixes)]))
+
+
+class MessageInfo(collections.namedtuple('MessageInfo', 'prefix mentions is_bot features')):
+    """What on_message figured out about a message.
+
+    prefix is the prefix the message starts with (or None), features is
+    a frozenset of the names of the message listeners interested in it.
+    """
+    __slots__ = ()
+
+
+_MessageListener = collections.namedtuple('_MessageListener', 'name predicate callback')
+
+
 VersionInfo = collections.namedtuple('VersionInfo', 'major minor micro')
 _chiaki_formatter = ChiakiFormatter(width=MAX_FORMATTER_WIDTH, show_check_failure=True)
 
@@ -124,7 +176,10 @@ class Chiaki(commands.Bot):
 
         self.message_counter = 0
         self.command_counter = collections.Counter()
-        self.custom_prefixes = JSONFile('customprefixes.json')
+        self.custom_prefixes = JSONFile('customprefixes.json', flush_interval=5)
+        self._prefix_matchers = {}
+        self._message_listeners = []
+        self._alias_resolvers = []
         self.cog_aliases = {}
 
         self.reset_requested = False
@@ -133,7 +188,14 @@ class Chiaki(commands.Bot):
         self.db = asyncqlio.DatabaseInterface(psql)
         self.loop.run_until_complete(self._connect_to_db())
 
-        self.db_scheduler = DatabaseScheduler(self.db, timefunc=datetime.utcnow)
+        # It's still called db_scheduler even if it's the in-memory one,
+        # because renaming it everywhere would be a pain.
+        if getattr(config, 'scheduler', 'database') == 'memory':
+            snapshot_path = f'{JSONS_PATH}schedule.json'
+            self.db_scheduler = QueueScheduler(timefunc=datetime.utcnow, snapshot_path=snapshot_path)
+        else:
+            listen_dsn = psql if getattr(config, 'scheduler_notify', False) else None
+            self.db_scheduler = DatabaseScheduler(self.db, timefunc=datetime.utcnow, listen_dsn=listen_dsn)
         self.db_scheduler.add_callback(self._dispatch_from_scheduler)
 
         for ext in config.extensions:
@@ -144,6 +206,7 @@ class Chiaki(commands.Bot):
             self.load_extension(ext)
 
         self._game_task = self.loop.create_task(self.change_game())
+        self._command_log_flusher = self.loop.create_task(self._flush_command_log())
 
     def _import_emojis(self):
         import emojis
@@ -184,9 +247,22 @@ class Chiaki(commands.Bot):
         await self.db.connect()
 
     async def close(self):
+        # Give the cogs a chance to save anything they haven't saved yet.
+        # This isn't dispatched like a normal event because we have to
+        # wait for them to finish before everything gets closed.
+        for listener in self.extra_events.get('on_shutdown', []):
+            try:
+                await listener()
+            except Exception:
+                log.exception('%r failed during shutdown', listener)
+
+        await self.custom_prefixes.close()
+        await self.db_scheduler.close()
         await self.session.close()
         await self.db.close()
         self._game_task.cancel()
+        self._command_log_flusher.cancel()
+        _command_log_handler.flush()
         await super().close()
 
     def add_cog(self, cog):
@@ -213,6 +289,15 @@ class Chiaki(commands.Bot):
         # remove cog aliases
         self.cog_aliases = {alias: real for alias, real in self.cog_aliases.items() if real is not cog}
 
+        self._message_listeners = [
+            listener for listener in self._message_listeners
+            if getattr(listener.callback, '__self__', None) is not cog
+        ]
+        self._alias_resolvers = [
+            resolver for resolver in self._alias_resolvers
+            if getattr(resolver, '__self__', None) is not cog
+        ]
+
     def get_cog(self, name):
         return self.all_cogs.get(name.lower())
 
@@ -256,6 +341,62 @@ class Chiaki(commands.Bot):
             asyncqlio.Index.get_ddl_sql = old_idx_ddl_sql
 
 
+    def add_message_listener(self, callback, predicate, *, name=None):
+        """Adds a listener that will only be called for certain messages.
+
+        Unlike a regular on_message listener, this only gets called if the
+        predicate returns True. The predicate takes the message and its
+        MessageInfo (minus the features), and must be cheap since it's run
+        on every message. Ideally it should check whether the message's
+        guild has the feature configured at all.
+
+        The callback is called with the message and its MessageInfo.
+
+        If the callback is a method of a cog, it will be removed
+        automatically when the cog is removed.
+        """
+        name = name or callback.__name__
+        self._message_listeners.append(_MessageListener(name, predicate, callback))
+
+    def remove_message_listener(self, callback):
+        self._message_listeners = [l for l in self._message_listeners if l.callback != callback]
+
+    def add_alias_resolver(self, resolver):
+        """Adds a coroutine that expands aliases while the context is made.
+
+        It's only called when the word after the prefix isn't a command. It
+        takes the message and its content after the prefix, and returns the
+        expanded content, or None if there's no alias.
+
+        If the resolver is a method of a cog, it will be removed
+        automatically when the cog is removed.
+        """
+        self._alias_resolvers.append(resolver)
+
+    def remove_alias_resolver(self, resolver):
+        self._alias_resolvers = [r for r in self._alias_resolvers if r != resolver]
+
+    async def _expand_alias(self, message, prefix):
+        content = message.content[len(prefix):]
+        for resolver in self._alias_resolvers:
+            expanded = await resolver(message, content)
+            if expanded is not None:
+                return expanded
+        return None
+
+    def classify_message(self, message):
+        """Returns the MessageInfo for a message."""
+        match = self.get_prefix_matcher(message.guild).match(message.content)
+        info = MessageInfo(
+            prefix=match and match.group(),
+            mentions=bool(message.mentions),
+            is_bot=message.author.bot,
+            features=frozenset(),
+        )
+
+        features = frozenset(l.name for l in self._message_listeners if l.predicate(message, info))
+        return info._replace(features=features)
+
     @contextlib.contextmanager
     def temp_listener(self, func, name=None):
         """Context manager for temporary listeners"""
@@ -265,6 +406,11 @@ class Chiaki(commands.Bot):
         finally:
             self.remove_listener(func)
 
+    async def _flush_command_log(self):
+        while True:
+            await asyncio.sleep(COMMAND_LOG_FLUSH_INTERVAL)
+            _command_log_handler.flush()
+
     async def change_game(self):
         await self.wait_until_ready()
         while True:
@@ -290,12 +436,67 @@ class Chiaki(commands.Bot):
     def get_raw_guild_prefixes(self, guild):
         return self.custom_prefixes.get(guild.id, self.default_prefix)
 
+    def get_prefix_matcher(self, guild):
+        """Returns a compiled regex that matches any of the guild's prefixes,
+        including the mentions.
+
+        Passing None returns the one used in DMs.
+        """
+        key = guild and guild.id
+        try:
+            return self._prefix_matchers[key]
+        except KeyError:
+            prefixes = self.get_raw_guild_prefixes(guild) if guild else self.default_prefix
+            matcher = self._prefix_matchers[key] = _compile_prefixes(self.user.id, prefixes)
+            return matcher
+
     async def set_guild_prefixes(self, guild, prefixes):
         prefixes = prefixes or []
         if len(prefixes) > 10:
             raise RuntimeError("You have too many prefixes you indecisive goof!")
 
         await self.custom_prefixes.put(guild.id, sorted(set(prefixes), reverse=True))
+        self._prefix_matchers.pop(guild.id, None)
+
+    async def get_context(self, message, *, cls=context.Context):
+        # This is mostly the same as commands.Bot.get_context, except that
+        # the prefix is matched using the guild's precompiled matcher rather
+        # than calling the command_prefix function each time, which is
+        # a waste considering how many messages go through here.
+        view = StringView(message.content)
+        ctx = cls(prefix=None, view=view, bot=self, message=message)
+
+        if self._skip_check(message.author.id, self.user.id):
+            return ctx
+
+        match = self.get_prefix_matcher(message.guild).match(message.content)
+        if match is None:
+            return ctx
+
+        prefix = match.group()
+        view.skip_string(prefix)
+        invoker = view.get_word()
+        command = self.all_commands.get(invoker)
+
+        if command is None and self._alias_resolvers:
+            # Aliases are expanded here rather than by re-processing a copy of
+            # the message, so an aliased command only gets one context, one
+            # session and one round of checks, just like any other command.
+            #
+            # This means ctx.message.content is still what was actually typed,
+            # so anything that needs the expanded version (like the command
+            # log) has to use ctx.expanded_content instead.
+            expanded = await self._expand_alias(message, prefix)
+            if expanded is not None:
+                ctx.expanded_content = f'{prefix}{expanded}'
+                ctx.view = view = StringView(expanded)
+                invoker = view.get_word()
+                command = self.all_commands.get(invoker)
+
+        ctx.invoked_with = invoker
+        ctx.prefix = prefix
+        ctx.command = command
+        return ctx
 
     async def process_commands(self, message):
         # prevent responding to other bots
@@ -307,7 +508,10 @@ class Chiaki(commands.Bot):
         if ctx.command is None:
             return
 
-        async with ctx.acquire():
+        # Most commands don't touch the DB at all, so there's no point in
+        # acquiring a connection for them. The checks might still need it
+        # though, so the session is still there, it's just lazy.
+        async with ctx.acquire(lazy=not _needs_db(_invoked_command(ctx))):
             await self.invoke(ctx)
 
     # --------- Events ----------
@@ -379,14 +583,28 @@ class Chiaki(commands.Bot):
 
     async def on_message(self, message):
         self.message_counter += 1
-        await self.process_commands(message)
+        info = self.classify_message(message)
+
+        # Much like Client.dispatch, but only for the listeners that actually
+        # care about this message. Most messages won't have any.
+        for listener in self._message_listeners:
+            if listener.name in info.features:
+                coro = self._run_event(listener.callback, listener.name, message, info)
+                self.loop.create_task(coro)
+
+        # No prefix means it can't be a command. There's no point in making
+        # the whole context for this.
+        if info.prefix is not None and not info.is_bot:
+            await self.process_commands(message)
 
     async def on_command(self, ctx):
         self.command_counter['commands'] += 1
         self.command_counter['executed in DMs'] += isinstance(ctx.channel, discord.abc.PrivateChannel)
-        fmt = ('Command executed in {0.channel} ({0.channel.id}) from {0.guild} ({0.guild.id}) '
-               'by {0.author} ({0.author.id}) Message: "{0.message.content}"')
-        command_log.info(fmt.format(ctx))
+        # Otherwise there'd be no telling what an aliased command actually ran.
+        expanded = f' Expanded: "{ctx.expanded_content}"' if ctx.expanded_content is not None else ''
+        command_log.info('Command executed in %s (%s) from %s (%s) by %s (%s) Message: "%s"%s',
+                         ctx.channel, ctx.channel.id, ctx.guild, getattr(ctx.guild, 'id', None),
+                         ctx.author, ctx.author.id, ctx.message.content, expanded)
 
     async def on_command_completion(self, ctx):
         self.command_counter['succeeded'] += 1
@@ -25,7 +25,7 @@ class Cog:
     def __init__(self, bot):
         self.bot = bot
 
-    def __init_subclass__(cls, *, name=None, hidden=False, aliases=(), **kwargs):
+    def __init_subclass__(cls, *, name=None, hidden=False, aliases=(), needs_db=True, **kwargs):
         super().__init_subclass__(**kwargs)
 
         cls_name = cls.__name__
@@ -33,6 +33,9 @@ class Cog:
         cls.name = name or (cls_name if cls_name.isupper() else re.sub(r"(\w)([A-Z])", r"\1 \2", cls_name))
         cls.__aliases__ = aliases
         cls.__hidden__ = hidden
+        # Whether or not the commands in this cog will (most likely) use the DB.
+        # If not, the session won't acquire a connection until it's used.
+        cls.__needs_db__ = needs_db
 
         # Set the local/global checks
         for attr in ('local_check', 'global_check', 'global_check_once'):
@@ -1,22 +1,73 @@
 import asyncio
+import asyncqlio
 import collections
 import contextlib
 import discord
 import random
 import sys
 
+from asyncqlio.orm.session import SessionState
 from discord.ext import commands
 from itertools import starmap
 
 
-class _ContextSession(collections.namedtuple('_ContextSession', 'ctx')):
+class _LazySession(asyncqlio.Session):
+    """A session that only acquires a connection when it's actually used.
+
+    Building queries (session.select, session.insert etc.) doesn't need a
+    connection, only running them does. So we can defer acquiring the
+    connection until one of the methods that actually hit the DB is called.
+
+    Note that session.transaction will be None until that happens.
+    """
+    def __init__(self, bind, counter=None):
+        super().__init__(bind)
+        self._counter = counter
+
+    @property
+    def started(self):
+        return self._state is not SessionState.NOT_READY
+
+    async def start(self):
+        await super().start()
+        if self._counter is not None:
+            self._counter['connections acquired'] += 1
+        return self
+
+    def _make_lazy(name):
+        async def method(self, *args, **kwargs):
+            if not self.started:
+                await self.start()
+            return await getattr(super(_LazySession, self), name)(*args, **kwargs)
+
+        method.__name__ = name
+        return method
+
+    # Everything that runs a query goes through one of these.
+    fetch = _make_lazy('fetch')
+    execute = _make_lazy('execute')
+    cursor = _make_lazy('cursor')
+    insert_now = _make_lazy('insert_now')
+    update_now = _make_lazy('update_now')
+    delete_now = _make_lazy('delete_now')
+    del _make_lazy
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.started:
+            # Nothing was ever done, so there's nothing to commit or roll back.
+            self._state = SessionState.CLOSED
+            return False
+        return await super().__aexit__(exc_type, exc, tb)
+
+
+class _ContextSession(collections.namedtuple('_ContextSession', 'ctx lazy')):
     __slots__ = ()
 
     def __await__(self):
-        return self.ctx._acquire().__await__()
+        return self.ctx._acquire(self.lazy).__await__()
 
     async def __aenter__(self):
-        return await self.ctx._acquire()
+        return await self.ctx._acquire(self.lazy)
 
     async def __aexit__(self, exc_type, exc, tb):
         return await self.ctx._release(exc_type, exc, tb)
@@ -26,6 +77,10 @@ class Context(commands.Context):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.session = None
+        self._lazy = False
+        # The message's content with the alias expanded, if the command was
+        # invoked through one. message.content is left alone either way.
+        self.expanded_content = None
 
     @property
     def clean_prefix(self):
@@ -38,12 +93,21 @@ class Context(commands.Context):
         """The bot's database connection interface, if applicable."""
         return getattr(self.bot, 'db', None)
 
-    async def _acquire(self):
+    async def _acquire(self, lazy=None):
+        if lazy is None:
+            # Re-acquiring (e.g. after ctx.release()) should keep the
+            # same behaviour as the original acquire.
+            lazy = self._lazy
+        self._lazy = lazy
+
         if self.session is None:
-            self.session = await self.db.get_session().__aenter__()
+            self.session = _LazySession(self.db, self.bot.command_counter)
+
+        if not (lazy or self.session.started):
+            await self.session.start()
         return self.session
 
-    def acquire(self):
+    def acquire(self, *, lazy=None):
         """Acquires a database session.
 
         Can be used in an async context manager: ::
@@ -55,9 +119,12 @@ class Context(commands.Context):
                 await ctx.db.execute(...)
             finally:
                 await ctx.release()
+
+        If lazy is True, the connection won't be acquired until the
+        session is actually used to run a query.
         """
         # DatabaseInterface.get_session doesn't support a timeout kwarg sadly...
-        return _ContextSession(self)
+        return _ContextSession(self, lazy)
 
     async def _release(self, exc_type, exc, tb):
         """Internal method used for properly propagating the exceptions
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+from cogs.utils import jsonf
+
+
+def _open(tmp_path, monkeypatch, loop):
+    monkeypatch.setattr(jsonf, 'JSONS_PATH', f'{tmp_path}/')
+    return jsonf.JSONFile('test.json', journal=True, loop=loop)
+
+
+def test_journal_survives_torn_line(tmp_path, monkeypatch):
+    loop = asyncio.new_event_loop()
+    try:
+        db = _open(tmp_path, monkeypatch, loop)
+        loop.run_until_complete(db.put('before', 1))
+
+        # Pretend the bot died halfway through appending a line.
+        with open(tmp_path / 'test.json.journal', 'a') as f:
+            f.write('["put","torn",')
+
+        db = _open(tmp_path, monkeypatch, loop)
+        assert dict(db) == {'before': 1}
+        loop.run_until_complete(db.put('after', 2))
+
+        db = _open(tmp_path, monkeypatch, loop)
+        assert dict(db) == {'before': 1, 'after': 2}
+    finally:
+        loop.close()
+
+
+def test_journal_replays(tmp_path, monkeypatch):
+    loop = asyncio.new_event_loop()
+    try:
+        db = _open(tmp_path, monkeypatch, loop)
+        loop.run_until_complete(db.put('a', 1))
+        loop.run_until_complete(db.put('b', 2))
+        loop.run_until_complete(db.remove('a'))
+
+        with open(tmp_path / 'test.json.journal') as f:
+            assert [json.loads(line)[0] for line in f] == ['put', 'put', 'remove']
+
+        db = _open(tmp_path, monkeypatch, loop)
+        assert dict(db) == {'b': 2}
+    finally:
+        loop.close()
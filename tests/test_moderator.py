@@ -0,0 +1,80 @@
+import asyncio
+import json
+import logging
+import types
+
+import discord
+
+from cogs import modlog, moderator
+from cogs.utils import jsonf
+
+
+def _make_cog(tmp_path, monkeypatch, slowmodes):
+    monkeypatch.setattr(jsonf, 'JSONS_PATH', f'{tmp_path}/')
+    (tmp_path / 'slowmodes.json').write_text(json.dumps(slowmodes))
+
+    bot = types.SimpleNamespace(loop=asyncio.get_event_loop(),
+                                add_message_listener=lambda *args, **kwargs: None)
+    return moderator.Moderator(bot)
+
+
+def test_slowmodes_load(tmp_path, monkeypatch):
+    cog = _make_cog(tmp_path, monkeypatch, {
+        '1234': {'5678': {'duration': 5, 'no_immune': False}},
+    })
+
+    slowmode = cog._slowmodes[1234][5678]
+    assert (slowmode.duration, slowmode.no_immune) == (5, False)
+
+
+def test_slowmodes_skip_guild_name_keys(tmp_path, monkeypatch, caplog):
+    # slowmode noimmune used to save these under the guild's name.
+    with caplog.at_level(logging.WARNING, logger=moderator.__name__):
+        cog = _make_cog(tmp_path, monkeypatch, {
+            'Some Guild': {'5678': {'duration': 10, 'no_immune': True}},
+            '1234': {'5678': {'duration': 5, 'no_immune': False}},
+        })
+
+    assert list(cog._slowmodes) == [1234]
+    assert 'Some Guild' in caplog.text
+
+
+class _Message:
+    async def edit(self, **kwargs):
+        pass
+
+
+def test_massban_raw_id(tmp_path, monkeypatch):
+    cog = _make_cog(tmp_path, monkeypatch, {})
+    loop = cog.bot.loop
+
+    async def send(content):
+        return _Message()
+
+    async def get_user_info(user_id):
+        # As if the user couldn't be found.
+        return None
+
+    bot = types.SimpleNamespace(
+        loop=loop,
+        user=types.SimpleNamespace(id=10, avatar_url='https://example.com/bot.png'),
+        get_cog=lambda name: None,
+        get_user=lambda user_id: None,
+        get_user_info=get_user_info,
+    )
+    ctx = types.SimpleNamespace(bot=bot, author=types.SimpleNamespace(id=20),
+                                guild=types.SimpleNamespace(id=30), send=send)
+
+    target = discord.Object(id=1234)
+
+    async def ban(member):
+        pass
+
+    succeeded = loop.run_until_complete(cog._mass_action(ctx, [target], ban, done='Banned'))
+    assert [m.id for m in ctx.mod_targets] == [1234]
+    assert succeeded == ctx.mod_targets
+
+    # This used to blow up in the mod-log's after_invoke hook.
+    mod_log = types.SimpleNamespace(bot=bot)
+    embed = modlog.ModLog._create_embed(mod_log, 1, 'massban', ctx.author, ctx.mod_targets, 'raid', None)
+    assert embed.fields[0].value == '1234'
@@ -0,0 +1,20 @@
+from cogs import modlog
+from cogs.modlog import ActionFlag
+
+
+def test_new_flags_follow_old_ones():
+    events = ActionFlag.kick | ActionFlag.mute | ActionFlag.ban
+    migrated = ActionFlag(modlog._add_new_flags(events))
+
+    assert migrated & ActionFlag.masskick
+    assert migrated & ActionFlag.massmute
+    assert migrated & events == events
+
+
+def test_new_flags_stay_off_if_old_ones_are():
+    events = ActionFlag.ban | ActionFlag.warn
+    assert modlog._add_new_flags(events) == events
+
+
+def test_default_flags_have_new_flags():
+    assert modlog._add_new_flags(modlog._default_flags) == modlog._default_flags